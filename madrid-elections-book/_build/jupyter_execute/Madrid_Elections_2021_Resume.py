@@ -33,13 +33,187 @@ from bs4 import BeautifulSoup
 import requests
 
 
+# Todas las descargas pasan por una misma sesión de `requests`: así se reutilizan las conexiones TCP/TLS con keep-alive (pool de conexiones por servidor), se pide la respuesta comprimida (gzip, y brotli si está instalado), cada petición tiene un timeout y los errores 5xx transitorios se reintentan con espera exponencial. La función `fetch_stats()` nos dice cuántas conexiones se han abierto y cuántas se han reutilizado.
+
+# In[ ]:
+
+
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# (timeout de conexión, timeout de lectura) en segundos:
+HTTP_TIMEOUT = (5, 30)
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_session(pool_size=16, retries=3, backoff=0.5):
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retry = Retry(total=retries, backoff_factor=backoff,
+                          status_forcelist=[500, 502, 503, 504], allowed_methods=['GET', 'HEAD'])
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+            http_session = session
+    
+    return http_session
+
+
+# Además, como el libro se vuelve a ejecutar entero en cada build (`execute_notebooks: force`), guardamos cada respuesta en una caché en disco dentro del directorio del libro (`_cache/http`):
+# 
+# * El cuerpo de cada respuesta se guarda una sola vez en `objetos/`, con su hash sha256 como nombre.
+# * Por cada url se guarda en `urls/` un pequeño json con el hash del cuerpo y las cabeceras `ETag` y `Last-Modified`, que usamos para revalidar con una petición condicional: si la página no ha cambiado el servidor responde 304 sin volver a enviarla.
+# * Con `HTTP_OFFLINE = True` (o la variable de entorno `ELECCIONES_OFFLINE=1`) no se hace ninguna petición: todo se sirve desde la caché y si falta una url se lanza `CacheMiss`.
+
+# In[ ]:
+
+
+import hashlib
+import json
+import os
+import tempfile
+
+HTTP_CACHE_DIR = '_cache/http'
+HTTP_OFFLINE = os.environ.get('ELECCIONES_OFFLINE', '') not in ('', '0')
+
+cache_stats = {'cache_hits': 0, 'cache_revalidadas': 0, 'cache_descargas': 0}
+cache_stats_lock = threading.Lock()
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+def count_cache(counter):
+    with cache_stats_lock:
+        cache_stats[counter] += 1
+
+
+def atomic_write(path, data):
+    # escribimos en un temporal del mismo directorio y lo renombramos, así nunca queda un fichero a medias:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def cache_entry_path(url):
+    return os.path.join(HTTP_CACHE_DIR, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def cache_object_path(digest):
+    return os.path.join(HTTP_CACHE_DIR, 'objetos', digest)
+
+
+def cache_read(url):
+    try:
+        with open(cache_entry_path(url), encoding='utf-8') as f:
+            entry = json.load(f)
+        with open(cache_object_path(entry['sha256']), 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None, None
+    
+    return entry, content
+
+
+def cache_write(url, response):
+    content = response.content
+    digest = hashlib.sha256(content).hexdigest()
+    if not os.path.exists(cache_object_path(digest)):
+        atomic_write(cache_object_path(digest), content)
+    
+    entry = {}
+    entry['url'] = url
+    entry['sha256'] = digest
+    entry['encoding'] = response.encoding or response.apparent_encoding
+    entry['etag'] = response.headers.get('ETag')
+    entry['last_modified'] = response.headers.get('Last-Modified')
+    atomic_write(cache_entry_path(url), json.dumps(entry).encode('utf-8'))
+    
+    return entry, content
+
+
+def fetch_content(url, timeout=HTTP_TIMEOUT, offline=None):
+    # devuelve la entrada de la caché, el cuerpo en bytes y si ha cambiado respecto a lo guardado:
+    offline = HTTP_OFFLINE if offline is None else offline
+    entry, content = cache_read(url)
+    
+    if offline:
+        if entry is None:
+            raise CacheMiss('%s no está en la caché %s y estamos en modo offline' % (url, HTTP_CACHE_DIR))
+        count_cache('cache_hits')
+        return entry, content, False
+    
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    
+    response = get_session().get(url, timeout=timeout, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        count_cache('cache_revalidadas')
+        return entry, content, False
+    response.raise_for_status()
+    
+    count_cache('cache_descargas')
+    new_entry, new_content = cache_write(url, response)
+    changed = entry is None or entry['sha256'] != new_entry['sha256']
+    
+    return new_entry, new_content, changed
+
+
+def fetch(url, timeout=HTTP_TIMEOUT, offline=None):
+    entry, content, changed = fetch_content(url, timeout, offline)
+    
+    return content.decode(entry['encoding'] or 'utf-8', errors='replace')
+
+
+def fetch_bytes(url, timeout=HTTP_TIMEOUT, offline=None):
+    entry, content, changed = fetch_content(url, timeout, offline)
+    
+    return content
+
+
+def fetch_stats():
+    # urllib3 cuenta por cada pool las conexiones creadas y las peticiones hechas:
+    opened = 0
+    requests_made = 0
+    for adapter in set(get_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            opened += pools[key].num_connections
+            requests_made += pools[key].num_requests
+    
+    stats = {}
+    stats['peticiones'] = requests_made
+    stats['conexiones_abiertas'] = opened
+    stats['conexiones_reutilizadas'] = requests_made - opened
+    with cache_stats_lock:
+        stats.update(cache_stats)
+    
+    return stats
+
+
 # ### 1.0.-Preparación de los datos de 2019: 
 # Obtenemos el texto html de la web y vemos que el elemento ul donde se aloja el resumen de municipios tiene la clase 'estirar':
 
 # In[2]:
 
 
-html_text = requests.get('https://resultados.elpais.com/elecciones/2019/autonomicas/12/').text
+html_text = fetch('https://resultados.elpais.com/elecciones/2019/autonomicas/12/')
 soup = BeautifulSoup(html_text, 'lxml')
 # soup
 
@@ -90,7 +264,7 @@ results_2019[0]
 link_pruebas = 'https://resultados.elpais.com/elecciones/2019/autonomicas/12/28/78.html'
 
 # obtenemos el código html:
-html_text_municipio = requests.get(link_pruebas).text
+html_text_municipio = fetch(link_pruebas)
 soup = BeautifulSoup(html_text_municipio, 'lxml')
 # soup
 
@@ -225,15 +399,12 @@ def result_partido_resume(results_table_partido):
 result_partido_resume(results_table_partido)
 
 
-# Ya podemos aplicar sobre todos los municipios. Para ellos definimos dos funciones que resumen lo que hemos hecho en ambas tablas:
+# Ya podemos aplicar sobre todos los municipios. Para ellos definimos dos funciones que resumen lo que hemos hecho en ambas tablas. Como las dos tablas están en la misma página, descargamos y procesamos cada página una sola vez y extraemos de ella ambas tablas:
 
 # In[13]:
 
 
-def table_escrutado(link):
-    html_text_municipio = requests.get(link).text
-    soup = BeautifulSoup(html_text_municipio, 'lxml')
-
+def parse_table_escrutado(soup):
     table_escrutado = soup.find('table', {'id': 'tablaResumen'})
     table_escrutado_trs = table_escrutado.find_all('tr')
     
@@ -248,14 +419,7 @@ def table_escrutado(link):
     
     return results_table_escrutado
 
-
-# In[14]:
-
-
-def table_partido(link):
-    html_text_municipio = requests.get(link).text
-    soup = BeautifulSoup(html_text_municipio, 'lxml')
-    
+def parse_table_partido(soup):
     table_partido = soup.find('table', {'id': 'tablaVotosPartidos'})
     table_partido_trs = table_partido.find_all('tr')
     
@@ -270,6 +434,27 @@ def table_partido(link):
         
     return results_table_partido
 
+def page_municipio(link):
+    # una sola descarga y un solo parseo por municipio para las dos tablas:
+    html_text_municipio = fetch(link)
+    soup = BeautifulSoup(html_text_municipio, 'lxml')
+    
+    page = {}
+    page['escrutinio'] = parse_table_escrutado(soup)
+    page['partidos'] = parse_table_partido(soup)
+    
+    return page
+
+
+# In[14]:
+
+
+def table_escrutado(link):
+    return page_municipio(link)['escrutinio']
+
+def table_partido(link):
+    return page_municipio(link)['partidos']
+
 
 # Aplicamos sobre la url inicial desde la que accederemos a todos los municipios:
 
@@ -286,8 +471,9 @@ for li in lis:
         local_result = {}
         local_result['municipio'] = link.text
         local_result['link'] = url+link.get('href')
-        local_result['escrutinio'] = table_escrutado(local_result['link'])
-        local_result['partidos'] = table_partido(local_result['link'])
+        page = page_municipio(local_result['link'])
+        local_result['escrutinio'] = page['escrutinio']
+        local_result['partidos'] = page['partidos']
         results_pruebas.append(local_result)
         
 results_pruebas[0]
@@ -318,13 +504,16 @@ len(results_pruebas)
 la_acebeda = {}
 la_acebeda['municipio'] = 'La Acebeda'
 la_acebeda['link'] = 'https://resultados.elpais.com/elecciones/2019/autonomicas/12/28/01.html'
-la_acebeda['escrutinio'] = table_escrutado(la_acebeda['link'])
-la_acebeda['partidos'] = table_partido(la_acebeda['link'])
+page = page_municipio(la_acebeda['link'])
+la_acebeda['escrutinio'] = page['escrutinio']
+la_acebeda['partidos'] = page['partidos']
 results_pruebas.insert(0, la_acebeda)
 
 results_pruebas[0]
 
 
+# Más adelante (apartado 1.1) veremos que este problema desaparece si generamos los enlaces a partir de los códigos INE de los municipios en lugar de leerlos de la página índice.
+# 
 # Pasamos a presentar la información de una forma que nos sea más fácil de tratar como dataframe:
 
 # In[19]:
@@ -384,463 +573,1088 @@ df.count()
 
 # La información geoespacial la hemos obtenido del siguiente enlace: https://raw.githubusercontent.com/FMullor/TopoJson/master/MadridMunicipios.geojson.
 # 
-# Nos va a servir para poder realizar mapas de la distribución del voto en cada municipio.
+# Nos va a servir para poder realizar mapas de la distribución del voto en cada municipio. Al cruzar la columna 'municipio' del geojson (182 registros) con la de nuestro dataframe aparecían estos problemas:
+# 
+# * 38 nombres con acentos o eñes mal codificados (por ejemplo 'AlcalÃ¡ de Henares' en lugar de 'Alcalá de Henares').
+# * 'Arroyomolinos' aparece dos veces con la misma geometría, así que basta con quedarse con uno.
+# * 'Horcajo de la Sierra' es el 'Horcajo de la Sierra-Aoslos' de nuestros datos.
+# * 'Jurisdicción Macomunada de El Boalo y Manzanares el Real (El Chaparral)' y 'Jurisdicción Mancomunada de Cerdedilla y Navacerrada' no son municipios: tienen una geometría distinta de la de Manzanares el Real y Navacerrada, y no cruzan con ningún municipio.
+# * La única geometría sin datos era la de La Acebeda, que es como supimos qué municipio faltaba en la página índice.
+# 
+# Todas estas correcciones se hacen en `clean_map_municipios` y `prepare_map_municipios` (apartado 1.1), que resuelven los nombres contra el índice de códigos INE y guardan las geometrías ya limpias en caché, así que no hace falta descargar ni corregir el geojson en cada ejecución. El cruce de los datos de 2019 con las geometrías lo hacemos por código INE en el apartado 1.2.1, junto con los de 2021.
 
-# In[23]:
+# ### 1.1.-Resumen del procedimiento:
+# Todo el proceso hasta obtener una primera versión del dataframe se puede resumir en las siguientes funciones:
 
+# In[40]:
 
-import geopandas as gpd
-import matplotlib.pyplot as plt
 
-# sacamos la info del link y ordenamos por orden alfabético los municipios:
-municipios = 'https://raw.githubusercontent.com/FMullor/TopoJson/master/MadridMunicipios.geojson'
-map_municipios = gpd.read_file(municipios)
-map_municipios = map_municipios.sort_values('municipio')
-map_municipios.head()
+def parse_table_escrutado(soup):
+    table_escrutado = soup.find('table', {'id': 'tablaResumen'})
+    table_escrutado_trs = table_escrutado.find_all('tr')
+    
+    results_table_escrutado = []
+    for tr in table_escrutado_trs:
+        local_table_escrutado = {}
+        local_table_escrutado['encabezado'] = None if tr.select_one('.encabezado') is None else tr.select_one('.encabezado').text
+        local_table_escrutado['numero'] = None if tr.select_one('.tipoNumero') is None else tr.select_one('.tipoNumero').text
+        local_table_escrutado['porcentaje'] = None if tr.select_one('.tipoPorciento') is None else tr.select_one('.tipoPorciento').text
+    
+        results_table_escrutado.append(local_table_escrutado)
+    
+    return results_table_escrutado
 
 
-# In[24]:
+def parse_table_partido(soup):
+    table_partido = soup.find('table', {'id': 'tablaVotosPartidos'})
+    table_partido_trs = table_partido.find_all('tr')
+    
+    results_table_partido = []
+    for tr in table_partido_trs:
+        local_table_partido = {}
+        local_table_partido['partido'] = None if tr.select_one('.nombrePartido') is None else tr.select_one('.nombrePartido').text
+        local_table_partido['numero_votos'] = None if tr.select_one('.tipoNumeroVotos') is None else tr.select_one('.tipoNumeroVotos').text
+        local_table_partido['porcentaje'] = None if tr.select_one('.tipoPorcientoVotos') is None else tr.select_one('.tipoPorcientoVotos').text
+    
+        results_table_partido.append(local_table_partido)
+        
+    return results_table_partido
 
 
-map_municipios.info()
+# Para comparar, añadimos un segundo parser que trabaja directamente sobre el árbol de lxml: las expresiones XPath se compilan una sola vez y cada fila de la tabla se recorre una única vez buscando las tres clases de sus celdas, en lugar de evaluar seis selectores CSS de BeautifulSoup por fila. Los diccionarios que devuelve son los mismos y se elige con `parser='lxml'` o `parser='bs4'`:
 
+# In[ ]:
 
-# Como podemos ver, el geodataframe map_municipios tiene como máximo 182 registros. A la hora de poder cruzar la información con nuestros dataframes, vemos que la columna 'municipio' tiene 182 registros, lo que significa que hay 3 elementos de más sabiendo que la Comunidad de Madrid tiene 179 municipios. Tenemos que investigar si hay elementos repetitivos y cuáles son. Una vez limpio, solo nos interesan las columnas 'municipio' y 'geometry':
 
-# In[25]:
+from lxml import etree
+import lxml.html
 
+XPATH_TABLE_TRS = etree.XPath("(//table[@id=$id])[1]//tr")
+XPATH_TEXT = etree.XPath("string()")
 
-map_municipios = map_municipios[['municipio', 'geometry']]
-map_municipios
+# clase css de la celda -> clave del diccionario:
+FIELDS_ESCRUTADO = {'encabezado': 'encabezado', 'tipoNumero': 'numero', 'tipoPorciento': 'porcentaje'}
+FIELDS_PARTIDO = {'nombrePartido': 'partido', 'tipoNumeroVotos': 'numero_votos', 'tipoPorcientoVotos': 'porcentaje'}
 
+def parse_table_lxml(tree, table_id, fields):
+    results_table = []
+    for tr in XPATH_TABLE_TRS(tree, id=table_id):
+        local_table = dict.fromkeys(fields.values())
+        missing = len(fields)
+        for element in tr.iterdescendants(etree.Element):
+            for css_class in element.get('class', '').split():
+                field = fields.get(css_class)
+                # como select_one, nos quedamos con la primera celda de cada clase:
+                if field is not None and local_table[field] is None:
+                    local_table[field] = XPATH_TEXT(element)
+                    missing -= 1
+            if missing == 0:
+                break
+        
+        results_table.append(local_table)
+    
+    return results_table
 
-# Vemos que hay municipios cuyo nombre al tener acentos o caracteres especiales no aparece correctamente y no va a coincidir con la información de nuestro dataframe. Para obtenerlos, hacemos: 
 
-# In[26]:
+# In[41]:
 
 
-no_intersection_map = set(map_municipios['municipio']).difference(set(df['municipio']))
-len(no_intersection_map)
-no_intersection_map
+def page_municipio(link, parser='bs4'):
+    # una sola descarga y un solo parseo por municipio para las dos tablas:
+    return parse_page(fetch(link), parser)
 
 
-# Por lo tanto, procedemos a corregir los nombres:
-
-# In[27]:
-
-
-map_municipios['municipio'] = map_municipios['municipio'].replace([
- 'AlcalÃ¡ de Henares',
- 'AlcorcÃ³n',
- 'CarabaÃ±a',
- 'ChapinerÃ\xada',
- 'ChinchÃ³n',
- 'CobeÃ±a',
- 'El VellÃ³n',
- 'El Ã\x81lamo',
- 'FuentidueÃ±a de Tajo',
- 'GriÃ±Ã³n',
- 'Horcajo de la Sierra',
- 'JurisdicciÃ³n Macomunada de El Boalo y Manzanares el Real (El Chaparral)',
- 'JurisdicciÃ³n Mancomunada de Cerdedilla y Navacerrada',
- 'LeganÃ©s',
- 'Morata de TajuÃ±a',
- 'MÃ³stoles',
- 'Navarredonda y San MamÃ©s',
- 'Nuevo BaztÃ¡n',
- 'Orusco de TajuÃ±a',
- 'Perales de TajuÃ±a',
- 'PinuÃ©car-Gandullas',
- 'Pozuelo de AlarcÃ³n',
- 'PrÃ¡dena del RincÃ³n',
- 'RascafrÃ\xada',
- 'RedueÃ±a',
- 'San AgustÃ\xadn del Guadalix',
- 'San MartÃ\xadn de Valdeiglesias',
- 'San MartÃ\xadn de la Vega',
- 'San SebastiÃ¡n de los Reyes',
- 'Santa MarÃ\xada de la Alameda',
- 'TorrejÃ³n de Ardoz',
- 'TorrejÃ³n de Velasco',
- 'TorrejÃ³n de la Calzada',
- 'ValdepiÃ©lagos',
- 'Valverde de AlcalÃ¡',
- 'Villanueva de la CaÃ±ada',
- 'Villarejo de SalvanÃ©s',
- 'Villaviciosa de OdÃ³n'
-], [
- 'Alcalá de Henares',
- 'Alcorcón',
- 'Carabaña',
- 'Chapinería',
- 'Chinchón',
- 'Cobeña',
- 'El Vellón',
- 'El Álamo',
- 'Fuentidueña de Tajo',
- 'Griñón',
- 'Horcajo de la Sierra',
- 'Jurisdicción Macomunada de El Boalo y Manzanares el Real (El Chaparral)',
- 'Jurisdicción Mancomunada de Cerdedilla y Navacerrada',
- 'Leganés',
- 'Morata de Tajuña',
- 'Móstoles',
- 'Navarredonda y San Mamés',
- 'Nuevo Baztán',
- 'Orusco de Tajuña',
- 'Perales de Tajuña',
- 'Piñuécar-Gandullas',
- 'Pozuelo de Alarcón',
- 'Prádena del Rincón',
- 'Rascafría',
- 'Redueña',
- 'San Agustín del Guadalix',
- 'San Martín de Valdeiglesias',
- 'San Martín de la Vega',
- 'San Sebastián de los Reyes',
- 'Santa María de la Alameda',
- 'Torrejón de Ardoz',
- 'Torrejón de Velasco',
- 'Torrejón de la Calzada',
- 'Valdepiélagos',
- 'Valverde de Alcalá',
- 'Villanueva de la Cañada',
- 'Villarejo de Salvanés',
- 'Villaviciosa de Odón'])
-
-map_municipios.head()
-
-
-# Vemos si hay valores repetidos:
-
-# In[28]:
-
-
-# sacamos los nombres de los municipios y los metemos en una lista:
-municipios = map_municipios['municipio'].to_list()
-#comprobamos qué nombres de municipios pueden estar repetidos:
-set([x for x in municipios if municipios.count(x) > 1])
-
-
-# Vemos si los valores de 'geometry' de 'Arroyomolinos' son los mismos y por lo tanto se pueden eliminar sin problema:
-
-# In[29]:
-
-
-map_municipios[map_municipios['municipio'] == 'Arroyomolinos']
-
-
-# Son los mismos, se puede eliminar un registro:
-
-# In[30]:
-
-
-# nos quedamos solo con un valor de Arroyomolinos (keep = 'first'):
-map_municipios.drop_duplicates(subset ="municipio", keep = 'first', inplace = True)
-map_municipios[map_municipios['municipio'] == 'Arroyomolinos']
-
-
-# Vemos si pueden haber diferencias entre los nombres de los municipios:
-
-# In[31]:
-
-
-no_intersection_map = set(map_municipios['municipio']).difference(set(df['municipio']))
-len(no_intersection_map)
-no_intersection_map
+def parse_page(html_text_municipio, parser='bs4'):
+    from bs4 import BeautifulSoup
+    
+    page = {}
+    if parser == 'lxml':
+        tree = lxml.html.document_fromstring(html_text_municipio)
+        page['escrutinio'] = parse_table_lxml(tree, 'tablaResumen', FIELDS_ESCRUTADO)
+        page['partidos'] = parse_table_lxml(tree, 'tablaVotosPartidos', FIELDS_PARTIDO)
+    elif parser == 'bs4':
+        soup = BeautifulSoup(html_text_municipio, 'lxml')
+        page['escrutinio'] = parse_table_escrutado(soup)
+        page['partidos'] = parse_table_partido(soup)
+    else:
+        raise ValueError("parser tiene que ser 'bs4' o 'lxml', no %r" % parser)
+    
+    return page
 
 
-# Comprobamos con qué nombres se corresponderían estos municipios de map_municipios con los que tenemos en nuestro dataframe:
-# 
-# * Horcajo de la Sierra : Horcajo de la Sierra-Aoslos,
-# * Jurisdicción Macomunada de El Boalo y Manzanares el Real (El Chaparral) : Manzanares el Real,
-# * Jurisdicción Mancomunada de Cerdedilla y Navacerrada : Navacerrada
+def table_escrutado(link, parser='bs4'):
+    return page_municipio(link, parser)['escrutinio']
 
-# Antes de corregir los nombres, comprobamos si ya existen en map_municipios:
 
-# In[32]:
+def table_partido(link, parser='bs4'):
+    return page_municipio(link, parser)['partidos']
 
 
-map_municipios[map_municipios['municipio'] == 'Horcajo de la Sierra-Aoslos']
+# Comprobamos con la página de pruebas de Madarcos que los dos parsers devuelven exactamente lo mismo:
 
+# In[ ]:
 
-# In[33]:
 
+page_municipio(link_pruebas, parser='lxml') == page_municipio(link_pruebas, parser='bs4')
 
-map_municipios[map_municipios['municipio'] == 'Manzanares el Real']
 
+# In[42]:
 
-# In[34]:
 
+def clean_strings_and_turn_float(value):
+    if ' %' in value:
+        return value.replace(' %', '').replace(',', '.')
+    else:
+        return value.replace('.', '')
+    
+def result_resume(results_table_escrutado, clean=True):
+    # con clean=False los textos se dejan tal cual y se convierten después columna a columna (parse_numeric_columns):
+    clean_value = clean_strings_and_turn_float if clean else (lambda value: value)
+    results_resume = []
+    for result in results_table_escrutado:
+        local_resume = {}
+        if result.get('encabezado') == 'Escrutado:':
+            local_resume['escrutado'] = clean_value(result.get('porcentaje'))
+        if result.get('encabezado') == 'Votos contabilizados:':
+            local_resume['votos_totales'] = clean_value(result.get('numero'))
+            local_resume['votos_totales_porcentaje'] = clean_value(result.get('porcentaje'))
+        if result.get('encabezado') == 'Abstenciones:':
+            local_resume['abstencion'] = clean_value(result.get('numero'))
+            local_resume['abstencion_porcentaje'] = clean_value(result.get('porcentaje'))
+        if result.get('encabezado') == 'Votos nulos:':
+            local_resume['votos_nulos'] = clean_value(result.get('numero'))
+            local_resume['votos_nulos_porcentaje'] = clean_value(result.get('porcentaje'))
+        if result.get('encabezado') == 'Votos en blanco:':
+            local_resume['votos_blancos'] = clean_value(result.get('numero'))
+            local_resume['votos_blancos_porcentaje'] = clean_value(result.get('porcentaje'))
+        
+        results_resume.append(local_resume)
 
-map_municipios[map_municipios['municipio'] == 'Navacerrada']
+    return results_resume
 
 
-# Se ve que 'Horcajo de la Sierra-Aoslos' es el único que no existe, por lo tanto se puede reemplazar.
-# 
-# Tenemos que ver si los otros dos pares de nombres de municipios tienen los mismos valores de 'geometry':
+# In[43]:
 
-# In[35]:
 
+def strip_accents(text):
+    import unicodedata
+    try:
+        text = unicode(text, 'utf-8')
+    except NameError: # unicode is a default on python 3 
+        pass
 
-geometry_1 = map_municipios[map_municipios['municipio'] == 'Manzanares el Real']['geometry']
-geometry_2 = map_municipios[map_municipios['municipio'] == 'Jurisdicción Macomunada de El Boalo y Manzanares el Real (El Chaparral)']['geometry'] 
+    text = unicodedata.normalize('NFD', text)           .encode('ascii', 'ignore')           .decode("utf-8")
 
-print(geometry_1)
-print(geometry_2)
+    return str(text)
 
 
-# In[36]:
+# Los nombres de los partidos se repiten en todos los municipios y en todos los años (apenas unas decenas distintos), así que guardamos en memoria la clave de cada nombre en lugar de normalizarla (`strip_accents`) en cada fila. El registro `PARTY_ALIASES` además traduce a una misma clave los nombres con los que un mismo partido o coalición aparece en distintos años, para que las columnas coincidan entre elecciones. Con `register_party_alias` se pueden añadir nuevos alias:
 
+# In[ ]:
 
-geometry_3 = map_municipios[map_municipios['municipio'] == 'Navacerrada']['geometry']
-geometry_4 = map_municipios[map_municipios['municipio'] == 'Jurisdicción Mancomunada de Cerdedilla y Navacerrada']['geometry'] 
 
-print(geometry_3)
-print(geometry_4)
+from functools import lru_cache
 
+# nombre normalizado en la web -> clave estable entre años:
+PARTY_ALIASES = {
+    "c's": 'cs',
+    'ciudadanos': 'cs',
+    'podemos_izquierda_unida': 'podemos_iu',
+    'unidas_podemos_iu': 'podemos_iu',
+    'iucm_lv': 'iu',
+    'iu_cm': 'iu',
+}
 
-# No tienen el mismo valor de 'geometry', por lo tanto solo vamos a corregir 'Horcajo de la Sierra' y los otros dos desaparecerán a la hora de mergear con nuestro dataframe:
+def normalize_party_name(partido):
+    return strip_accents(partido.lower().replace('-', '_').replace(' ', '_'))
 
-# In[37]:
 
+@lru_cache(maxsize=None)
+def party_key(partido):
+    key = normalize_party_name(partido)
+    
+    return PARTY_ALIASES.get(key, key)
 
-map_municipios['municipio'] = map_municipios['municipio'].replace({
-    'Horcajo de la Sierra': 'Horcajo de la Sierra-Aoslos',
-})
 
-no_intersection_map = set(map_municipios['municipio']).difference(set(df['municipio']))
-len(no_intersection_map)
-no_intersection_map
+def register_party_alias(partido, key):
+    PARTY_ALIASES[normalize_party_name(partido)] = key
+    party_key.cache_clear()
 
 
-# Ya podemos mergear para que nuestro dataframe tenga información geoespacial:
+# In[44]:
 
-# In[38]:
 
+def result_partido_resume(results_table_partido, clean=True):
+    clean_value = clean_strings_and_turn_float if clean else (lambda value: value)
+    results_resume_partido = []
+    for result in results_table_partido:
+        local_resume = {}
+        if result.get('partido') == None:
+            continue
+        else:
+            partido = party_key(result.get('partido'))
+            local_resume[partido] = clean_value(result.get('numero_votos'))
+            local_resume[partido+'_porcentaje'] = clean_value(result.get('porcentaje'))
+    
+        results_resume_partido.append(local_resume)
 
-df_2019 = pd.merge(df, map_municipios, how='left', on='municipio')
-df_2019.info()
+    return results_resume_partido
 
 
-# Pasamos las columnas a valores numéricos, excepto 'municipio', 'link' y 'geometry':
+# Recorrer los 179 municipios uno detrás de otro hace que el tiempo total sea 179 veces la latencia de cada página. Para poder descargar varias páginas a la vez sin saturar resultados.elpais.com limitamos las peticiones por servidor con un "token bucket": cada servidor repone `rate` fichas por segundo (con ráfagas de hasta `burst`) y cada petición consume una. Todas las descargas a un mismo servidor comparten su cubeta, y si piden límites distintos se aplica el más bajo.
 
-# In[39]:
+# In[45]:
 
 
-cols = df_2019.columns.drop(['municipio', 'link', 'geometry'])
+import threading
+import time
 
-df_2019[cols] = df_2019[cols].apply(pd.to_numeric, errors='coerce', axis=1)
-df_2019.info()
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def take(self):
+        # reservamos la ficha dentro del lock y esperamos fuera de él:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+host_buckets = {}
+host_buckets_lock = threading.Lock()
+
+def host_bucket(link, rate, burst=1):
+    from urllib.parse import urlparse
+    
+    # una sola cubeta por servidor; si otra descarga pide otro límite, se queda el más estricto de los dos:
+    host = urlparse(link).netloc
+    with host_buckets_lock:
+        if host not in host_buckets:
+            host_buckets[host] = TokenBucket(rate, burst)
+        bucket = host_buckets[host]
+    with bucket.lock:
+        bucket.rate = min(bucket.rate, rate)
+        bucket.burst = min(bucket.burst, burst)
+        bucket.tokens = min(bucket.tokens, bucket.burst)
+    return bucket
+
+
+# Si la descarga se interrumpe a mitad (un timeout, el límite de tiempo de la celda...) no queremos empezar de cero. Cada municipio descargado se apunta en un diario (`_cache/checkpoints`, un fichero json por línea y solo se añaden líneas), y al volver a llamar a `extract_data_from_web(url)` solo se descargan los que faltan:
+# 
+# * Cada registro se escribe con una sola escritura seguida de `fsync`; si la última línea quedó a medias (o una línea está corrupta) se descarta al leer el diario.
+# * Solo se dan por terminados los municipios con el escrutinio al 100%; los demás se vuelven a pedir.
+# * Cuando la descarga termina completa, el diario se borra (`retire_checkpoint`), así que la siguiente ejecución vuelve a consultar la web (con peticiones condicionales gracias a la caché).
+# * `invalidate_checkpoint(url, links)` añade una marca que invalida esos municipios (o borra el diario entero si no se pasan links) para que se vuelvan a descargar.
 
+# In[ ]:
 
-# ### 1.1.-Resumen del procedimiento:
-# Todo el proceso hasta obtener una primera versión del dataframe se puede resumir en las siguientes funciones:
 
-# In[40]:
+CHECKPOINT_DIR = '_cache/checkpoints'
+checkpoint_lock = threading.Lock()
 
+def checkpoint_path(url):
+    return os.path.join(CHECKPOINT_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '.jsonl')
 
-def table_escrutado(link):
-    from bs4 import BeautifulSoup
-    import requests
+
+def append_checkpoint(path, record):
+    line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+    with checkpoint_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            written = 0
+            while written < len(line):
+                written += os.write(fd, line[written:])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def escrutinio_finished(record):
+    for result in record.get('escrutinio', []):
+        if result.get('encabezado') == 'Escrutado:':
+            try:
+                return float(clean_strings_and_turn_float(result.get('porcentaje') or '')) >= 100
+            except ValueError:
+                return False
+    return False
+
+
+def read_checkpoint(path):
+    # link -> registro de cada municipio ya descargado, con el escrutinio terminado y no invalidado:
+    done = {}
+    if not os.path.exists(path):
+        return done
     
-    html_text_municipio = requests.get(link).text
-    soup = BeautifulSoup(html_text_municipio, 'lxml')
+    valid_size = 0
+    with checkpoint_lock, open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            valid_size += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # una línea completa pero corrupta se ignora, como si ese municipio no estuviera en el diario
+                continue
+            if record.get('invalidado') or not escrutinio_finished(record):
+                done.pop(record.get('link'), None)
+            else:
+                done[record['link']] = record
+        # quitamos una última línea a medias para que lo siguiente que se escriba empiece en una línea nueva:
+        if valid_size < os.path.getsize(path):
+            os.truncate(path, valid_size)
+    
+    return done
 
-    table_escrutado = soup.find('table', {'id': 'tablaResumen'})
-    table_escrutado_trs = table_escrutado.find_all('tr')
+
+def retire_checkpoint(path):
+    # con todos los municipios descargados el diario ya no hace falta:
+    with checkpoint_lock:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def invalidate_checkpoint(url, links=None):
+    path = checkpoint_path(url)
+    if links is None:
+        retire_checkpoint(path)
+        return
     
-    results_table_escrutado = []
-    for tr in table_escrutado_trs:
-        local_table_escrutado = {}
-        local_table_escrutado['encabezado'] = None if tr.select_one('.encabezado') is None else tr.select_one('.encabezado').text
-        local_table_escrutado['numero'] = None if tr.select_one('.tipoNumero') is None else tr.select_one('.tipoNumero').text
-        local_table_escrutado['porcentaje'] = None if tr.select_one('.tipoPorciento') is None else tr.select_one('.tipoPorciento').text
+    for link in links:
+        append_checkpoint(path, {'link': link, 'invalidado': True})
+
+
+# Las páginas de cada municipio siguen siempre el mismo patrón: `.../autonomicas/12/28/NN.html`, donde 28 es el código INE de la provincia de Madrid y NN el del municipio. En lugar de depender de la página índice (que en 2019 se dejó fuera La Acebeda), usamos un índice versionado con los códigos INE de los 179 municipios (`municipios_ine.csv`) para generar directamente los enlaces. El código INE también nos sirve de clave numérica para cruzar con `map_municipios` en lugar de los nombres. `check_ine_index(url)` compara el índice con la página índice de El País por si hubiera que actualizarlo:
+
+# In[ ]:
+
+
+import re
+
+INE_INDEX_PATH = 'municipios_ine.csv'
+
+def ine_index(path=INE_INDEX_PATH):
+    import pandas as pd
+    return pd.read_csv(path, comment='#', dtype={'ine': 'int64', 'municipio': 'object'})
+
+
+def ine_index_version(path=INE_INDEX_PATH):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('# version:'):
+                return line.split(':', 1)[1].strip()
+
+
+def ine_link(url, ine):
+    # 28079 (Madrid) -> .../28/79.html
+    return '%s%d/%02d.html' % (url, ine // 1000, ine % 1000)
+
+
+def ine_from_link(link):
+    match = re.search(r'/(\d+)/(\d+)\.html$', link)
+    return int(match.group(1)) * 1000 + int(match.group(2))
+
+
+def add_ine(df):
+    # la clave numérica sale del propio link de cada municipio (si ya está, por ejemplo al repetir la celda, se recalcula):
+    ine = df['link'].map(ine_from_link).astype('int64')
+    if 'ine' in df:
+        df['ine'] = ine
+    else:
+        df.insert(1, 'ine', ine)
     
-        results_table_escrutado.append(local_table_escrutado)
+    return df
+
+
+def check_ine_index(url, path=INE_INDEX_PATH):
+    index = ine_index(path)
+    index_links = {ine_link(url, ine): municipio for ine, municipio in zip(index['ine'], index['municipio'])}
+    web_links = dict((link, municipio) for municipio, link in municipio_links(url, index_lis(url)))
     
-    return results_table_escrutado
+    report = {}
+    report['version'] = ine_index_version(path)
+    report['solo_en_indice'] = sorted(index_links[link] for link in set(index_links) - set(web_links))
+    report['solo_en_web'] = sorted(web_links[link] for link in set(web_links) - set(index_links))
+    report['nombres_distintos'] = sorted(
+        (index_links[link], web_links[link]) for link in set(index_links) & set(web_links)
+        if index_links[link] != web_links[link]
+    )
+    
+    return report
 
 
-# In[41]:
+# In[ ]:
 
 
-def table_partido(link):
-    from bs4 import BeautifulSoup
-    import requests
+def municipio_links(url, lis=None):
+    # sin lista de la página índice, los enlaces salen del índice de códigos INE:
+    if lis is None:
+        index = ine_index()
+        return [(municipio, ine_link(url, ine)) for ine, municipio in zip(index['ine'], index['municipio'])]
     
-    html_text_municipio = requests.get(link).text
-    soup = BeautifulSoup(html_text_municipio, 'lxml')
+    links = []
+    for li in lis:
+        for link in li.find_all('a'):
+            links.append((link.text, url+link.get('href')))
     
-    table_partido = soup.find('table', {'id': 'tablaVotosPartidos'})
-    table_partido_trs = table_partido.find_all('tr')
+    return links
+
+
+def fetch_municipio(municipio, link, rate=None, burst=1, parser='bs4', checkpoint=None):
+    if rate is not None:
+        host_bucket(link, rate, burst).take()
     
-    results_table_partido = []
-    for tr in table_partido_trs:
-        local_table_partido = {}
-        local_table_partido['partido'] = None if tr.select_one('.nombrePartido') is None else tr.select_one('.nombrePartido').text
-        local_table_partido['numero_votos'] = None if tr.select_one('.tipoNumeroVotos') is None else tr.select_one('.tipoNumeroVotos').text
-        local_table_partido['porcentaje'] = None if tr.select_one('.tipoPorcientoVotos') is None else tr.select_one('.tipoPorcientoVotos').text
+    local_result = {}
+    local_result['municipio'] = municipio
+    local_result['link'] = link
+    page = page_municipio(link, parser)
+    local_result['escrutinio'] = page['escrutinio']
+    local_result['partidos'] = page['partidos']
+    # lo apuntamos en el diario en cuanto termina, aunque llegue antes que municipios anteriores:
+    if checkpoint:
+        append_checkpoint(checkpoint, local_result)
     
-        results_table_partido.append(local_table_partido)
+    return local_result
+
+
+def iter_data_from_web(url, lis=None, workers=1, rate=None, burst=1, parser='bs4', checkpoint=None):
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+    
+    links = municipio_links(url, lis)
+    # los municipios que ya están en el diario no se vuelven a descargar:
+    done = read_checkpoint(checkpoint) if checkpoint else {}
+    pending = [(municipio, link) for municipio, link in links if link not in done]
+    municipios = [municipio for municipio, link in pending]
+    hrefs = [link for municipio, link in pending]
+    fetch_one = partial(fetch_municipio, rate=rate, burst=burst, parser=parser, checkpoint=checkpoint)
+    
+    if workers > 1:
+        # executor.map devuelve los resultados en el mismo orden que los enlaces, según van llegando:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        fetched = executor.map(fetch_one, municipios, hrefs)
+    else:
+        executor = None
+        fetched = map(fetch_one, municipios, hrefs)
+    
+    try:
+        for municipio, link in links:
+            yield done[link] if link in done else next(fetched)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    if checkpoint:
+        retire_checkpoint(checkpoint)
+
+
+def prepare_data_from_web(url, lis=None, workers=1, rate=None, burst=1, parser='bs4', checkpoint=None):
+    data_from_web = list(iter_data_from_web(url, lis, workers=workers, rate=rate, burst=burst, parser=parser, checkpoint=checkpoint))
         
-    return results_table_partido
+    return data_from_web
 
 
-# In[42]:
+# In[46]:
 
 
-def clean_strings_and_turn_float(value):
-    if ' %' in value:
-        return value.replace(' %', '').replace(',', '.')
-    else:
-        return value.replace('.', '')
+def format_data(data_from_web, clean=True):
+    data_formatted = []
+    for data in data_from_web:
+        local_result = {}
+        local_result['municipio'] = data['municipio']
+        local_result['link'] = data['link']
+        local_result['escrutinio'] = result_resume(data['escrutinio'], clean)
+        local_result['partidos'] = result_partido_resume(data['partidos'], clean)
     
-def result_resume(results_table_escrutado):
-    results_resume = []
-    for result in results_table_escrutado:
-        local_resume = {}
-        if result.get('encabezado') == 'Escrutado:':
-            local_resume['escrutado'] = clean_strings_and_turn_float(result.get('porcentaje'))
-        if result.get('encabezado') == 'Votos contabilizados:':
-            local_resume['votos_totales'] = clean_strings_and_turn_float(result.get('numero'))
-            local_resume['votos_totales_porcentaje'] = clean_strings_and_turn_float(result.get('porcentaje'))
-        if result.get('encabezado') == 'Abstenciones:':
-            local_resume['abstencion'] = clean_strings_and_turn_float(result.get('numero'))
-            local_resume['abstencion_porcentaje'] = clean_strings_and_turn_float(result.get('porcentaje'))
-        if result.get('encabezado') == 'Votos nulos:':
-            local_resume['votos_nulos'] = clean_strings_and_turn_float(result.get('numero'))
-            local_resume['votos_nulos_porcentaje'] = clean_strings_and_turn_float(result.get('porcentaje'))
-        if result.get('encabezado') == 'Votos en blanco:':
-            local_resume['votos_blancos'] = clean_strings_and_turn_float(result.get('numero'))
-            local_resume['votos_blancos_porcentaje'] = clean_strings_and_turn_float(result.get('porcentaje'))
+        data_formatted.append(local_result)
+    
+    return data_formatted
+
+
+# In[47]:
+
+
+def data_frame_preparation(data_formatted):
+    ## dataframe preparation: una fila por municipio (row_from_data) y un único DataFrame(...) en rows_to_frame,
+    ## con las mismas columnas y orden que json_normalize + groupby().apply(bfill) + merge:
+    df = rows_to_frame(iter_rows(data_formatted))
+    
+    return df
+
+
+# También podemos encadenar todo el proceso como generadores (descarga → parseo → `result_resume`/`result_partido_resume` → fila final), de forma que cada municipio se convierte en su fila del dataframe en cuanto llega su página. Así el procesado se solapa con las descargas y no se guardan en memoria las listas intermedias.
+# 
+# La fila de cada municipio se monta directamente como un diccionario con todos sus partidos y su escrutinio, y el dataframe se crea con una sola llamada a `pd.DataFrame`. Es lo que usa también `data_frame_preparation`, en lugar de los dataframes largos de `json_normalize` (una fila casi vacía por partido) que había que colapsar con `groupby('municipio').apply(lambda x: x.bfill().head(1))`. Las columnas y el orden de las filas son los mismos que con el método anterior:
+
+# In[ ]:
+
+
+ESCRUTINIO_COLUMNS = [
+    'escrutado', 'votos_totales', 'votos_totales_porcentaje', 'abstencion', 'abstencion_porcentaje',
+    'votos_nulos', 'votos_nulos_porcentaje', 'votos_blancos', 'votos_blancos_porcentaje',
+]
+
+def iter_format_data(data_from_web, clean=True):
+    for data in data_from_web:
+        local_result = {}
+        local_result['municipio'] = data['municipio']
+        local_result['link'] = data['link']
+        local_result['escrutinio'] = result_resume(data['escrutinio'], clean)
+        local_result['partidos'] = result_partido_resume(data['partidos'], clean)
         
-        results_resume.append(local_resume)
+        yield local_result
 
-    return results_resume
 
+def row_from_data(data):
+    # una fila por municipio con todos los partidos y el escrutinio:
+    row = {}
+    row['municipio'] = data['municipio']
+    row['link'] = data['link']
+    for record in data['partidos'] + data['escrutinio']:
+        for key, value in record.items():
+            row.setdefault(key, value)
+    
+    return row
 
-# In[43]:
 
+def iter_rows(data_formatted):
+    for data in data_formatted:
+        yield row_from_data(data)
 
-def strip_accents(text):
-    import unicodedata
-    try:
-        text = unicode(text, 'utf-8')
-    except NameError: # unicode is a default on python 3 
-        pass
 
-    text = unicodedata.normalize('NFD', text)           .encode('ascii', 'ignore')           .decode("utf-8")
+def rows_to_frame(rows):
+    import pandas as pd
+    # mismo orden de columnas que data_frame_preparation: partidos y escrutinio por orden de aparición
+    rows = list(rows)
+    escrutinio = set(ESCRUTINIO_COLUMNS)
+    seen = {'municipio', 'link'}
+    partidos_columns = []
+    escrutinio_columns = []
+    for row in rows:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                (escrutinio_columns if key in escrutinio else partidos_columns).append(key)
+    
+    df = pd.DataFrame(rows, columns=['municipio', 'link'] + partidos_columns + escrutinio_columns)
+    df = df.sort_values('municipio', kind='mergesort').reset_index(drop=True)
+    
+    return df
 
-    return str(text)
 
+# Para pasar a números, en lugar de limpiar cada valor con `clean_strings_and_turn_float` y después aplicar `pd.to_numeric` fila a fila, convertimos cada columna de una vez con las operaciones vectorizadas de texto de pandas sobre los textos originales de la web ('1.234', '12,5 %'):
+# 
+# * Las columnas de votos pasan a `int64` (o `float64` si a algún municipio le falta el valor, por ejemplo un partido que no se presentó allí).
+# * Las columnas de porcentaje (`*_porcentaje` y `escrutado`) pasan a `float64`.
+# * Devuelve también un resumen por columna con los valores que no se han podido convertir.
 
-# In[44]:
+# In[ ]:
 
 
-def result_partido_resume(results_table_partido):
-    results_resume_partido = []
-    for result in results_table_partido:
-        local_resume = {}
-        if result.get('partido') == None:
+def is_percentage_column(column):
+    return column.endswith('_porcentaje') or column == 'escrutado'
+
+
+def parse_numeric_columns(df, columns=None):
+    import pandas as pd
+    
+    if columns is None:
+        columns = df.columns.drop(['municipio', 'ine', 'link', 'geometry'], errors='ignore')
+    
+    report = []
+    for column in columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
             continue
+        text = df[column].astype(object).str.strip()
+        if is_percentage_column(column):
+            text = text.str.replace('%', '', regex=False).str.strip().str.replace(',', '.', regex=False)
         else:
-            partido = strip_accents(result.get('partido').lower().replace('-', '_').replace(' ', '_'))
-            local_resume[partido] = clean_strings_and_turn_float(result.get('numero_votos'))
-            local_resume[partido+'_porcentaje'] = clean_strings_and_turn_float(result.get('porcentaje'))
+            text = text.str.replace('.', '', regex=False)
+        
+        values = pd.to_numeric(text, errors='coerce')
+        failed = text.notna() & (text != '') & values.isna()
+        if not is_percentage_column(column) and values.notna().all():
+            values = values.astype('int64')
+        else:
+            values = values.astype('float64')
+        
+        examples = list(df.loc[failed, column].head(3))
+        df[column] = values
+        report.append({'columna': column, 'dtype': str(values.dtype), 'fallos': int(failed.sum()), 'ejemplos': examples})
     
-        results_resume_partido.append(local_resume)
+    return df, pd.DataFrame(report, columns=['columna', 'dtype', 'fallos', 'ejemplos'])
 
-    return results_resume_partido
 
+def typed_frame(df):
+    import warnings
+    df, report = parse_numeric_columns(df)
+    failures = report[report['fallos'] > 0]
+    if len(failures):
+        warnings.warn('valores no numéricos: ' + ', '.join(
+            '%s (%d)' % (column, count) for column, count in zip(failures['columna'], failures['fallos'])
+        ))
+    
+    return df
 
-# In[45]:
 
+# In[48]:
 
-def prepare_data_from_web(url, lis):
-    data_from_web = []
-    for li in lis:
-        for link in li.find_all('a'):
-            local_result = {}
-            local_result['municipio'] = link.text
-            local_result['link'] = url+link.get('href')
-            local_result['escrutinio'] = table_escrutado(local_result['link'])
-            local_result['partidos'] = table_partido(local_result['link'])
-            
-            data_from_web.append(local_result)
+
+def index_lis(url):
+    from bs4 import BeautifulSoup
+    # html code processing from url:
+    html_text = fetch(url)
+    soup = BeautifulSoup(html_text, 'lxml')
+    ul = soup.select('ul.estirar')[1]
+    
+    return ul.find_all('li')
+
+
+def extract_data_from_web(url, workers=1, rate=None, burst=1, parser='bs4', stream=False, checkpoint=True, discover=False):
+    # diario de municipios ya descargados para poder retomar la descarga (checkpoint=False lo desactiva):
+    if checkpoint is True:
+        checkpoint = checkpoint_path(url)
+    # los enlaces salen del índice INE salvo que pidamos leer la página índice (discover=True):
+    lis = index_lis(url) if discover else None
+    if stream:
+        data_from_web = iter_data_from_web(url, lis, workers=workers, rate=rate, burst=burst, parser=parser, checkpoint=checkpoint)
+        return typed_frame(add_ine(rows_to_frame(iter_rows(iter_format_data(data_from_web, clean=False)))))
+    # preparing data before formatting (workers > 1 descarga los municipios en paralelo):
+    data_from_web = prepare_data_from_web(url, lis, workers=workers, rate=rate, burst=burst, parser=parser, checkpoint=checkpoint)
+    # data formatted:
+    data_formatted = format_data(data_from_web, clean=False)
+    ## dataframe (votos en int64 y porcentajes en float64)
+    df = typed_frame(add_ine(data_frame_preparation(data_formatted)))
+    
+    return df
+
+
+# El País publica los resultados de las últimas cinco elecciones autonómicas (2007, 2011, 2015, 2019 y 2021). Para descargar varios años a la vez, `extract_elections(years)` reparte las páginas de todos los municipios de todos los años entre un mismo conjunto de hilos (y el mismo límite de peticiones por servidor), en lugar de lanzar un `extract_data_from_web(url)` detrás de otro. Devuelve un diccionario con un dataframe por año:
+# 
+# ```python
+# elections = extract_elections([2007, 2011, 2015, 2019, 2021])
+# elections[2015]
+# ```
+
+# In[ ]:
+
+
+ELPAIS_URL = 'https://resultados.elpais.com/elecciones/{year}/autonomicas/12/'
+
+def extract_elections(years, workers=8, rate=10, burst=1, parser='bs4', checkpoint=True, discover=False):
+    from concurrent.futures import ThreadPoolExecutor
+    
+    urls = [ELPAIS_URL.format(year=year) for year in years]
+    data_from_web = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # páginas índice de todos los años a la vez (solo si no usamos el índice INE):
+        lis_by_year = list(executor.map(index_lis, urls)) if discover else [None] * len(urls)
         
-    return data_from_web
+        # y después todos los municipios de todos los años en la misma cola:
+        pending = {}
+        for year, url, lis in zip(years, urls, lis_by_year):
+            path = checkpoint_path(url) if checkpoint else None
+            done = read_checkpoint(path) if path else {}
+            pending[year] = [
+                done[link] if link in done
+                else executor.submit(fetch_municipio, municipio, link, rate, burst, parser, path)
+                for municipio, link in municipio_links(url, lis)
+            ]
+        
+        for year in years:
+            data_from_web[year] = [data if isinstance(data, dict) else data.result() for data in pending[year]]
+    
+    if checkpoint:
+        for url in urls:
+            retire_checkpoint(checkpoint_path(url))
+    
+    frames = {}
+    for year in years:
+        frames[year] = typed_frame(add_ine(rows_to_frame(iter_rows(iter_format_data(data_from_web[year], clean=False)))))
+    
+    return frames
 
 
-# In[46]:
+# La noche electoral los resultados se van actualizando según avanza el escrutinio. En lugar de volver a descargar los 179 municipios, `refresh_data_from_web(df)` solo vuelve a pedir los municipios con el escrutado por debajo del 100% (o todos con `check_changed=True`). Cada petición es condicional gracias a la caché (`ETag`/`Last-Modified` y el hash del cuerpo), así que solo se vuelven a procesar las páginas que han cambiado. Las filas se corrigen sobre el mismo dataframe y se devuelve un resumen de los valores que han cambiado. Si queda el diario de una descarga sin terminar, las páginas nuevas también se apuntan en él para que retomarla no deshaga la actualización:
 
+# In[ ]:
 
-def format_data(data_from_web):
-    data_formatted = []
-    for data in data_from_web:
-        local_result = {}
-        local_result['municipio'] = data['municipio']
-        local_result['link'] = data['link']
-        local_result['escrutinio'] = result_resume(data['escrutinio'])
-        local_result['partidos'] = result_partido_resume(data['partidos'])
+
+def index_url_from_link(link):
+    # .../autonomicas/12/28/79.html -> .../autonomicas/12/
+    return re.sub(r'\d+/\d+\.html$', '', link)
+
+
+def refresh_municipio(municipio, link, rate=None, burst=1, parser='bs4', checkpoint=None):
+    if rate is not None:
+        host_bucket(link, rate, burst).take()
+    
+    entry, content, changed = fetch_content(link)
+    if not changed:
+        return None
+    
+    page = parse_page(content.decode(entry['encoding'] or 'utf-8', errors='replace'), parser)
+    data = {'municipio': municipio, 'link': link, 'escrutinio': page['escrutinio'], 'partidos': page['partidos']}
+    # si hay una descarga a medias, su diario también tiene que quedar con la versión nueva:
+    if checkpoint:
+        append_checkpoint(checkpoint, data)
+    
+    import pandas as pd
+    row = next(iter_rows(iter_format_data([data], clean=False)))
+    row, report = parse_numeric_columns(pd.DataFrame([row]))
+    
+    return row.iloc[0].to_dict()
+
+
+def touch_frame(df):
+    # versión del dataframe: la sube cualquier función que cambie valores en el sitio, y con ella caducan sus agregados
+    df.attrs['version'] = df.attrs.get('version', 0) + 1
+    return df
+
+
+def refresh_data_from_web(df, workers=8, rate=10, burst=1, parser='bs4', check_changed=False):
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    
+    escrutado = pd.to_numeric(df['escrutado'], errors='coerce')
+    candidates = df.index if check_changed else df.index[~(escrutado >= 100)]
+    municipios = list(df.loc[candidates, 'municipio'])
+    links = list(df.loc[candidates, 'link'])
+    journals = [checkpoint_path(index_url_from_link(link)) for link in links]
+    journals = [path if os.path.exists(path) else None for path in journals]
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(
+            refresh_municipio, municipios, links,
+            [rate] * len(links), [burst] * len(links), [parser] * len(links), journals
+        ))
+    
+    changes = []
+    for index, row in zip(candidates, rows):
+        if row is None:
+            continue
+        for column, value in row.items():
+            if column not in df.columns:
+                df[column] = None
+            old_value = df.at[index, column]
+            if pd.isna(old_value) and pd.isna(value) or old_value == value:
+                continue
+            df.at[index, column] = value
+            changes.append({'municipio': row['municipio'], 'columna': column, 'antes': old_value, 'despues': value})
+    if changes:
+        touch_frame(df)
+    
+    return pd.DataFrame(changes, columns=['municipio', 'columna', 'antes', 'despues'])
+
+
+# En el apartado 1.0.2 vimos las diferencias de nombres entre el geojson y nuestros datos (38 nombres mal codificados y Horcajo de la Sierra), que al principio se corregían a mano. `resolve_names(names, targets)` lo hace automáticamente contra una lista de nombres de referencia (por ejemplo, los del índice INE):
+# 
+# * primero repara los nombres codificados dos veces (utf-8 leído como latin-1),
+# * después busca coincidencias exactas y, para los que quedan, coincidencias por clave normalizada (sin acentos, mayúsculas, signos ni artículos),
+# * y por último compara los restantes por trigramas usando un índice invertido, de modo que cada nombre solo se compara con los que comparten algún trigrama y nunca con los que ya se han asignado.
+# 
+# Devuelve el diccionario de nombres resueltos y un informe con el método usado para cada uno; los que no se han podido resolver aparecen con `destino` vacío:
+
+# In[ ]:
+
+
+NAME_STOPWORDS = {'el', 'la', 'los', 'las', 'de', 'del', 'y'}
+
+
+def repair_mojibake(text):
+    # texto utf-8 leído como latin-1 ('AlcorcÃ³n' -> 'Alcorcón'):
+    try:
+        return text.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text
+
+
+def name_key(name):
+    words = re.sub('[^a-z0-9]+', ' ', strip_accents(name).lower()).split()
+    return ' '.join(sorted(word for word in words if word not in NAME_STOPWORDS))
+
+
+def name_trigrams(key):
+    return {(' %s ' % word)[i:i + 3] for word in key.split() for i in range(len(word))}
+
+
+def resolve_names(names, targets, min_score=0.6):
+    import pandas as pd
+    from collections import Counter, defaultdict
+    
+    names = list(dict.fromkeys(names))
+    targets = list(dict.fromkeys(targets))
+    repaired = {name: repair_mojibake(name) for name in names}
+    resolved = {}
+    
+    # coincidencias exactas, antes o después de reparar la codificación:
+    target_set = set(targets)
+    for name in names:
+        if repaired[name] in target_set:
+            resolved[name] = (repaired[name], 'exacto' if repaired[name] == name else 'codificacion', 1.0)
+    used = {target for target, method, score in resolved.values()}
+    
+    # coincidencias por clave normalizada, solo si la clave identifica un único nombre libre:
+    by_key = defaultdict(list)
+    for target in targets:
+        if target not in used:
+            by_key[name_key(target)].append(target)
+    for name in names:
+        candidates = by_key.get(name_key(repaired[name]), [])
+        if name not in resolved and len(candidates) == 1 and candidates[0] not in used:
+            resolved[name] = (candidates[0], 'clave', 1.0)
+            used.add(candidates[0])
+    
+    # trigramas: índice invertido trigrama -> nombres libres que lo contienen
+    free = [target for target in targets if target not in used]
+    grams = [name_trigrams(name_key(target)) for target in free]
+    index = defaultdict(list)
+    for position, target_grams in enumerate(grams):
+        for gram in target_grams:
+            index[gram].append(position)
+    
+    pairs = []
+    for name in names:
+        if name in resolved:
+            continue
+        name_grams = name_trigrams(name_key(repaired[name]))
+        shared = Counter(position for gram in name_grams for position in index.get(gram, ()))
+        for position, count in shared.items():
+            score = 2 * count / (len(name_grams) + len(grams[position]))
+            if score >= min_score:
+                pairs.append((score, name, free[position]))
+    
+    # asignamos de mayor a menor parecido, sin repetir nombres de referencia:
+    for score, name, target in sorted(pairs, key=lambda pair: -pair[0]):
+        if name not in resolved and target not in used:
+            resolved[name] = (target, 'trigramas', round(score, 3))
+            used.add(target)
+    
+    report = pd.DataFrame([
+        {'nombre': name, 'reparado': repaired[name], 'destino': resolved.get(name, (None,))[0],
+         'metodo': resolved.get(name, (None, None))[1], 'puntuacion': resolved.get(name, (None, None, None))[2]}
+        for name in names
+    ], columns=['nombre', 'reparado', 'destino', 'metodo', 'puntuacion'])
+    
+    return {name: value[0] for name, value in resolved.items()}, report
+
+
+# La preparación de las geometrías que vimos en el apartado 1.0.2 queda en una función: los nombres se resuelven con `resolve_names` contra el índice INE y se elimina el Arroyomolinos duplicado. El resultado limpio se guarda como GeoParquet en `_cache/geo`, con el sha256 del geojson original como clave: mientras el fichero de origen no cambie, las siguientes ejecuciones leen directamente las geometrías limpias sin descargar ni corregir nada. Junto a las geometrías se guarda también el informe de `resolve_names`, que se obtiene con `report=True`. Solo se avisa de los nombres sin resolver que no estén en `MAP_NOT_MUNICIPIOS` (las dos jurisdicciones mancomunadas, que no son municipios). Con `refresh=True` se vuelve a comprobar el geojson en el servidor:
+
+# In[ ]:
+
+
+MUNICIPIOS_GEOJSON = 'https://raw.githubusercontent.com/FMullor/TopoJson/master/MadridMunicipios.geojson'
+GEO_CACHE_DIR = '_cache/geo'
+# se incrementa si cambia la limpieza, para no reutilizar ficheros limpiados con la versión anterior:
+GEO_CLEAN_VERSION = 3
+# nombres del geojson que no son municipios y que sabemos que no se resuelven:
+MAP_NOT_MUNICIPIOS = {
+    'Jurisdicción Macomunada de El Boalo y Manzanares el Real (El Chaparral)',
+    'Jurisdicción Mancomunada de Cerdedilla y Navacerrada',
+}
+
+
+def geo_cache_path(digest, root=GEO_CACHE_DIR):
+    # los nombres se resuelven contra el índice INE, así que su versión también forma parte de la clave:
+    return os.path.join(root, 'municipios-%s-%s-v%d.parquet' % (digest, ine_index_version(), GEO_CLEAN_VERSION))
+
+
+def geo_report_path(path):
+    return path[:-len('.parquet')] + '-nombres.parquet'
+
+
+def clean_map_municipios(map_municipios, names=None, known=MAP_NOT_MUNICIPIOS):
+    import warnings
+    
+    geo = map_municipios[['municipio', 'geometry']].copy()
+    if names is None:
+        names = ine_index()['municipio']
+    
+    # los que no se resuelven se quedan con el nombre reparado y no cruzarán con el índice (solo avisamos de los nuevos):
+    mapping, report = resolve_names(geo['municipio'], names)
+    unresolved = report[report['destino'].isna() & ~report['reparado'].isin(known)]
+    if len(unresolved):
+        warnings.warn('municipios sin resolver: ' + ', '.join(unresolved['reparado']))
+    geo['municipio'] = geo['municipio'].map(dict(zip(report['nombre'], report['destino'].fillna(report['reparado']))))
+    
+    # los repetidos (Arroyomolinos) tienen la misma geometría, nos quedamos con el primero:
+    geo = geo[~geo['municipio'].duplicated(keep='first')]
+    
+    return geo.sort_values('municipio').reset_index(drop=True), report
+
+
+def prepare_map_municipios(url=MUNICIPIOS_GEOJSON, refresh=False, offline=None, root=GEO_CACHE_DIR, report=False):
+    import io
+    import geopandas as gpd
+    import pandas as pd
+    
+    def cached(path):
+        geo = gpd.read_parquet(path)
+        return (geo, pd.read_parquet(geo_report_path(path))) if report else geo
+    
+    # sin refresh nos basta con la entrada de la caché http para saber qué versión del geojson tenemos:
+    entry = None
+    if not refresh:
+        try:
+            with open(cache_entry_path(url), encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            pass
+    if entry is not None and os.path.exists(geo_cache_path(entry['sha256'], root)):
+        return cached(geo_cache_path(entry['sha256'], root))
+    
+    entry, content, changed = fetch_content(url, offline=offline)
+    path = geo_cache_path(entry['sha256'], root)
+    if os.path.exists(path):
+        return cached(path)
+    
+    # el informe de nombres se guarda junto a las geometrías (antes que ellas, que son las que marcan la caché como completa):
+    geo, names = clean_map_municipios(gpd.read_file(io.BytesIO(content)))
+    os.makedirs(root, exist_ok=True)
+    names.to_parquet(geo_report_path(path) + '.tmp', index=False)
+    os.replace(geo_report_path(path) + '.tmp', geo_report_path(path))
+    geo.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    
+    return (geo, names) if report else geo
+
+
+# Los mapas de Bokeh incluyen los polígonos completos de `map_municipios` en el html, y eso es casi todo el peso de la página y del tiempo de dibujo. Por eso preparamos versiones simplificadas a varias tolerancias (en grados) sin que aparezcan huecos entre municipios vecinos: en lugar de simplificar cada polígono por separado, separamos las fronteras en arcos compartidos, simplificamos cada arco una sola vez, redondeamos las coordenadas y reconstruimos los polígonos a partir de los arcos. Cada nivel se comprueba antes de aceptarlo: si al simplificar se cruzan arcos, algún municipio pierde o junta caras o cambia mucho de área, y entonces el nivel se repite con menos tolerancia (o se descarta). `map_source` elige el nivel más detallado que cabe en `max_bytes`:
+
+# In[ ]:
+
+
+MAP_TOLERANCES = (0.0002, 0.0005, 0.001, 0.002, 0.005)
+MAP_MAX_BYTES = 500 * 1024
+# cuánto puede crecer o encoger el área de un municipio al simplificar:
+MAP_MAX_AREA_RATIO = 1.25
+
+
+def shared_arcs(geometries):
+    from shapely.ops import linemerge, unary_union
+    
+    # unary_union deja cada frontera común una sola vez, cortada donde se juntan tres o más municipios:
+    merged = linemerge(unary_union([geometry.boundary for geometry in geometries]))
+    return list(getattr(merged, 'geoms', [merged]))
+
+
+def quantize_line(line, decimals):
+    import numpy as np
+    from shapely.geometry import LineString
+    
+    coords = np.round(np.asarray(line.coords), decimals)
+    # quitamos los puntos repetidos que deja el redondeo:
+    keep = np.r_[True, (np.diff(coords, axis=0) != 0).any(axis=1)]
+    coords = coords[keep]
+    return LineString(coords) if len(coords) > 1 else None
+
+
+def simplify_topology(map_ine, tolerance, arcs=None):
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+    from shapely.ops import polygonize
+    
+    if arcs is None:
+        arcs = shared_arcs(map_ine.geometry)
+    decimals = int(np.ceil(-np.log10(tolerance / 10)))
+    lines = []
+    for arc in arcs:
+        # los extremos de cada arco no se mueven, así que los vecinos siguen compartiendo frontera;
+        # los anillos cerrados (enclaves) se simplifican sin dejar que se deshagan:
+        line = quantize_line(arc.simplify(tolerance, preserve_topology=arc.is_ring), decimals)
+        if line is not None:
+            lines.append(line)
     
-        data_formatted.append(local_result)
+    # cada cara se asigna al municipio que contiene su punto interior; las que no caen en ninguno son huecos:
+    faces = gpd.GeoDataFrame(geometry=list(polygonize(lines)), crs=map_ine.crs)
+    points = faces.representative_point()
+    ine = map_ine['ine'].to_numpy()
+    faces['ine'] = [next((ine[i] for i in map_ine.sindex.query(point, predicate='intersects')), None) for point in points]
+    faces = faces.dropna(subset=['ine']).astype({'ine': 'int64'})
     
-    return data_formatted
+    geo = map_ine[['ine']].merge(faces.dissolve(by='ine').reset_index()[['ine', 'geometry']], how='left', on='ine')
+    return gpd.GeoDataFrame(geo, geometry='geometry', crs=map_ine.crs), faces['ine'].value_counts()
 
 
-# In[47]:
+def level_problems(map_ine, geo, face_counts, max_area_ratio=MAP_MAX_AREA_RATIO):
+    import numpy as np
+    import pandas as pd
+    
+    # si al simplificar se cruzan dos arcos, polygonize junta o pierde caras: cada municipio tiene que
+    # conservar tantas caras como partes tenía y un área parecida a la original
+    parts = pd.Series([len(getattr(geometry, 'geoms', [geometry])) for geometry in map_ine.geometry], index=map_ine['ine'])
+    faces = face_counts.reindex(parts.index).fillna(0)
+    # la proporción de áreas no depende de la proyección, así que la calculamos sobre las coordenadas tal cual:
+    area = lambda geometries: np.array([np.nan if geometry is None else geometry.area for geometry in geometries])
+    ratio = area(geo.geometry) / area(map_ine.geometry)
+    area_ok = (ratio >= 1 / max_area_ratio) & (ratio <= max_area_ratio)
+    
+    return sorted(set(parts.index[faces.to_numpy() != parts.to_numpy()]) | set(parts.index[~area_ok]))
 
 
-def data_frame_preparation(data_formatted):
-    import pandas as pd
-    ## dataframe preparation
-    df_partidos = pd.json_normalize(data_formatted, record_path='partidos', meta=['municipio', 'link'])
-    df_partidos = df_partidos.groupby('municipio').apply(lambda x: x.bfill().head(1)).reset_index(drop=True)
+def simplify_levels(map_ine, tolerances=MAP_TOLERANCES, max_area_ratio=MAP_MAX_AREA_RATIO, retries=3):
+    import warnings
     
-    df_escrutinio = pd.json_normalize(data_formatted, record_path='escrutinio', meta=['municipio'])
-    df_escrutinio = df_escrutinio.groupby('municipio').apply(lambda x: x.bfill().head(1)).reset_index(drop=True)
+    # los arcos compartidos se calculan una sola vez para todos los niveles:
+    arcs = shared_arcs(map_ine.geometry)
     
-    df = pd.merge(df_partidos, df_escrutinio, on='municipio', how='outer')
-    ## columns position switched:
-    first_column = df.pop('municipio')
-    second_column = df.pop('link')
-    df.insert(0, 'municipio', first_column)
-    df.insert(1, 'link', second_column)
+    # lista de (tolerancia, geometrías, bytes del geojson), de más a menos detalle; la tolerancia 0 es la original
+    levels = [(0, map_ine[['ine', 'geometry']])]
+    for tolerance in sorted(tolerances):
+        # un nivel que no pasa la comprobación se repite con la mitad de tolerancia:
+        for attempt in range(retries + 1):
+            geo, face_counts = simplify_topology(map_ine, tolerance, arcs)
+            problems = level_problems(map_ine, geo, face_counts, max_area_ratio)
+            if not problems or tolerance / 2 <= levels[-1][0]:
+                break
+            tolerance = tolerance / 2
+        if problems:
+            warnings.warn('nivel de tolerancia %g descartado, municipios afectados: %s' % (tolerance, problems[:10]))
+            continue
+        if tolerance > levels[-1][0]:
+            levels.append((tolerance, geo))
     
-    return df
+    return [(tolerance, geo, len(geo.to_json())) for tolerance, geo in levels]
 
 
-# In[48]:
+def pick_map_level(levels, max_bytes=MAP_MAX_BYTES):
+    for level in levels:
+        if level[2] <= max_bytes:
+            return level
+    return levels[-1]
 
 
-def extract_data_from_web(url):
-    from bs4 import BeautifulSoup
-    import requests
-    # html code processing from url:
-    html_text = requests.get(url).text
-    soup = BeautifulSoup(html_text, 'lxml')
-    ul = soup.select('ul.estirar')[1]
-    lis = ul.find_all('li')
-    # preparing data before formatting:
-    data_from_web = prepare_data_from_web(url, lis)
-    # data formatted:
-    data_formatted = format_data(data_from_web)
-    ## dataframe 
-    df = data_frame_preparation(data_formatted)
+def map_source(df, levels, max_bytes=MAP_MAX_BYTES):
+    import pandas as pd
+    from geopandas import GeoDataFrame
+    from bokeh.models import GeoJSONDataSource
     
-    return df
+    tolerance, geo, nbytes = pick_map_level(levels, max_bytes)
+    result = pd.merge(df.drop(columns=['geometry'], errors='ignore'), geo, how='left', on='ine')
+    return GeoJSONDataSource(geojson=GeoDataFrame(result, geometry='geometry').to_json())
 
 
 # ### 1.2.-Preparación de los datos de 2021: 
 # 
-# Aplicamos la función que resumen el procedimiento:
+# Aplicamos la función que resumen el procedimiento, descargando 8 municipios a la vez (como mucho 10 páginas por segundo) y construyendo las filas del dataframe según llegan las páginas:
 
 # In[49]:
 
 
 url = 'https://resultados.elpais.com/elecciones/2021/autonomicas/12/'
-df_2021 = extract_data_from_web(url)
+df_2021 = extract_data_from_web(url, workers=8, rate=10, parser='lxml', stream=True)
 
 df_2021
 
@@ -851,37 +1665,77 @@ df_2021
 len(df_2021)
 
 
+# Conexiones abiertas y reutilizadas por la sesión compartida durante la descarga, y páginas servidas desde la caché:
+
+# In[ ]:
+
+
+fetch_stats()
+
+
 # Se ve que el número de municipios coincide con los que tiene la CAM; aún así vamos a comprobar antes de añadir la información geoespacial.
 
 # ### 1.2.1-Añadir información geoespacial al dataframe:
 
-# Vemos si pueden haber diferencias entre los nombres de los municipios:
+# Vemos si pueden haber diferencias entre los municipios de 2021 y los del índice de códigos INE:
 
 # In[51]:
 
 
-no_intersection_map = set(map_municipios['municipio']).difference(set(df_2021['municipio']))
+no_intersection_map = set(ine_index()['ine']).symmetric_difference(set(df_2021['ine']))
 len(no_intersection_map)
 no_intersection_map
 
 
-# Son los mismos que antes, procedemos a mergear los dataframes:
+# Son los mismos. Cargamos las geometrías ya limpias con `prepare_map_municipios()` (desde el GeoParquet en caché si el geojson no ha cambiado), asignamos a cada geometría su código INE y, a partir de aquí, cruzamos por código en lugar de por nombre (los datos de 2019 los pasamos por las mismas funciones que los de 2021, con `typed_frame` para los tipos y `add_ine` para el código):
+
+# In[ ]:
+
+
+map_municipios, map_report = prepare_map_municipios(report=True)
+
+index = ine_index()
+map_municipios['ine'] = map_municipios['municipio'].map(dict(zip(index['municipio'], index['ine'])))
+map_ine = map_municipios.dropna(subset=['ine']).astype({'ine': 'int64'})[['ine', 'geometry']]
+
+# 2019 con las mismas funciones que 2021, a partir de las páginas ya descargadas en el apartado 1.0 (votos en int64 y porcentajes en float64):
+df_2019 = typed_frame(add_ine(data_frame_preparation(format_data(results_pruebas, clean=False))))
+set(index['ine']).difference(set(map_ine['ine']))
+
+
+# Nombres del geojson que no coincidían tal cual con el índice INE y cómo se han resuelto, según el informe guardado con las geometrías (las dos jurisdicciones mancomunadas no son municipios y quedan sin resolver):
+
+# In[ ]:
+
+
+map_report[map_report['metodo'] != 'exacto']
+
+
+# Preparamos una vez los niveles de simplificación que usarán los mapas del apartado 2 y vemos cuánto ocupa cada uno:
+
+# In[ ]:
+
+
+map_levels = simplify_levels(map_ine)
+[(tolerance, nbytes) for tolerance, geo, nbytes in map_levels]
+
+
+# Procedemos a mergear los dataframes:
 
 # In[52]:
 
 
 import pandas as pd
-df_2021 = pd.merge(df_2021, map_municipios, how='left', on='municipio')
+df_2019 = pd.merge(df_2019, map_ine, how='left', on='ine')
+df_2021 = pd.merge(df_2021, map_ine, how='left', on='ine')
 df_2021.info()
 
 
 # In[53]:
 
 
-# pasamos a valores numéricos todas las columnas excepto 'municipio', 'link' y 'geometry':
-cols = df_2021.columns.drop(['municipio', 'link', 'geometry'])
-
-df_2021[cols] = df_2021[cols].apply(pd.to_numeric, errors='coerce', axis=1)
+# extract_data_from_web y typed_frame ya devuelven los votos y porcentajes como valores numéricos:
+df_2019.info()
 df_2021.info()
 
 
@@ -893,6 +1747,247 @@ df_2021.info()
 # datos_electorales_2021 = df_2021.to_csv('datos_electorales_2021.csv')
 
 
+# El CSV pierde la geometría y los tipos, así que guardamos los resultados en Parquet, un fichero por elección dentro de una carpeta `year=AAAA/`. Al leer se mapea el fichero en memoria y solo se cargan las columnas pedidas, y la misma función sirve para uno o varios años:
+
+# In[ ]:
+
+
+RESULTS_STORE_DIR = '_store/resultados'
+
+
+def results_path(year, root=RESULTS_STORE_DIR):
+    import os
+    return os.path.join(root, 'year=%d' % year, 'part-0.parquet')
+
+
+def save_results(df, year, root=RESULTS_STORE_DIR):
+    import os
+    import geopandas as gpd
+    
+    path = results_path(year, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    if 'geometry' in df.columns:
+        gpd.GeoDataFrame(df, geometry='geometry').to_parquet(tmp, index=False)
+    else:
+        df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def stored_years(root=RESULTS_STORE_DIR):
+    import os
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(name.split('=')[1]) for name in os.listdir(root)
+                  if name.startswith('year=') and os.path.exists(os.path.join(root, name, 'part-0.parquet')))
+
+
+def read_results(year, columns=None, root=RESULTS_STORE_DIR):
+    import json
+    import geopandas as gpd
+    import pyarrow.parquet as pq
+    
+    table = pq.read_table(results_path(year, root), columns=columns, memory_map=True)
+    df = table.to_pandas()
+    
+    # las columnas de geometría vienen en WKB y se describen en los metadatos 'geo' del fichero
+    metadata = table.schema.metadata or {}
+    if b'geo' in metadata:
+        geo = json.loads(metadata[b'geo'])
+        geometries = [column for column in geo['columns'] if column in df.columns]
+        for column in geometries:
+            df[column] = gpd.GeoSeries.from_wkb(df[column], crs=geo['columns'][column].get('crs'))
+        if geometries:
+            df = gpd.GeoDataFrame(df, geometry=geometries[0])
+    return df
+
+
+def load_results(years=None, columns=None, root=RESULTS_STORE_DIR):
+    import pandas as pd
+    
+    if years is None:
+        years = stored_years(root)
+    if isinstance(years, int):
+        return read_results(years, columns, root)
+    
+    frames = []
+    for year in years:
+        df = read_results(year, columns, root)
+        df.insert(0, 'year', year)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+# In[ ]:
+
+
+save_results(df_2019, 2019)
+save_results(df_2021, 2021)
+
+load_results([2019, 2021], columns=['municipio', 'pp', 'psoe', 'votos_totales']).groupby('year').sum(numeric_only=True)
+
+
+# Para tener a la vez en memoria muchas elecciones y regiones podemos pasar a un esquema compacto (opcional): el municipio como categoría, los votos en int32 (en `Int32` con nulos si el partido no se presenta en algún municipio, para no confundirlo con 0 votos), los porcentajes en float32 y los links en una tabla aparte indexada por código INE, ya que el análisis no los usa:
+
+# In[ ]:
+
+
+def compact_results(df):
+    import pandas as pd
+    
+    links = None
+    if 'link' in df.columns:
+        key = 'ine' if 'ine' in df.columns else 'municipio'
+        links = df[[key, 'link']].set_index(key)
+    
+    compact = df.drop(columns=['link'], errors='ignore').copy()
+    compact['municipio'] = compact['municipio'].astype('category')
+    if 'ine' in compact.columns:
+        compact['ine'] = compact['ine'].astype('int32')
+    
+    for column in compact.columns.drop(['municipio', 'ine', 'geometry'], errors='ignore'):
+        if not pd.api.types.is_numeric_dtype(compact[column]):
+            continue
+        if is_percentage_column(column):
+            compact[column] = compact[column].astype('float32')
+        else:
+            # NaN es un partido que no se presenta en el municipio, no 0 votos: esas columnas pasan a Int32 (con nulos)
+            values = compact[column]
+            if not (values.dropna() % 1 == 0).all():
+                compact[column] = values.astype('float32')
+            elif values.isna().any():
+                compact[column] = values.astype('Int32')
+            else:
+                compact[column] = values.astype('int32')
+    
+    return compact, links
+
+
+def memory_report(df, compact=None, links=None):
+    import pandas as pd
+    
+    if compact is None:
+        compact, links = compact_results(df)
+    
+    before = df.memory_usage(deep=True, index=False)
+    after = compact.memory_usage(deep=True, index=False)
+    if links is not None:
+        after['link'] = links.memory_usage(deep=True).sum()
+    
+    report = pd.DataFrame({'antes': before, 'despues': after.reindex(before.index)})
+    report.loc['total'] = report.sum()
+    report['ahorro_%'] = (100 * (1 - report['despues'] / report['antes'])).round(1)
+    return report
+
+
+# In[ ]:
+
+
+memory_report(df_2021).loc[['municipio', 'link', 'pp', 'pp_porcentaje', 'total']]
+
+
+# Para comparar elecciones sin copiar columnas de un dataframe a otro (como haremos con `df_abstenciones`) cargamos también los resultados en una base de datos SQLite en formato largo: una fila por año, código INE y partido en `resultados`, y una fila por año y municipio con los datos del escrutinio en `municipios`. Con los índices sobre esas claves, cualquier pregunta entre años o partidos es una consulta SQL con `query_warehouse`:
+
+# In[ ]:
+
+
+import sqlite3
+
+WAREHOUSE_PATH = '_store/elecciones.sqlite'
+
+WAREHOUSE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS municipios (
+    year INTEGER NOT NULL,
+    ine INTEGER NOT NULL,
+    municipio TEXT NOT NULL,
+    escrutado REAL,
+    votos_totales INTEGER,
+    votos_totales_porcentaje REAL,
+    abstencion INTEGER,
+    abstencion_porcentaje REAL,
+    votos_nulos INTEGER,
+    votos_nulos_porcentaje REAL,
+    votos_blancos INTEGER,
+    votos_blancos_porcentaje REAL,
+    PRIMARY KEY (year, ine)
+);
+CREATE TABLE IF NOT EXISTS resultados (
+    year INTEGER NOT NULL,
+    ine INTEGER NOT NULL,
+    partido TEXT NOT NULL,
+    votos INTEGER,
+    porcentaje REAL,
+    PRIMARY KEY (year, ine, partido)
+);
+CREATE INDEX IF NOT EXISTS resultados_partido ON resultados (partido, year);
+CREATE INDEX IF NOT EXISTS resultados_ine ON resultados (ine, year);
+"""
+
+
+def party_columns(df):
+    return [column for column in df.columns
+            if column + '_porcentaje' in df.columns and column not in ESCRUTINIO_COLUMNS]
+
+
+def long_results(df, year):
+    parties = party_columns(df)
+    votes = df.melt(id_vars=['ine'], value_vars=parties, var_name='partido', value_name='votos')
+    percentages = df.melt(id_vars=['ine'], value_vars=[party + '_porcentaje' for party in parties], value_name='porcentaje')
+    # melt recorre las columnas en el mismo orden, así que las filas de ambos coinciden:
+    votes['porcentaje'] = percentages['porcentaje'].to_numpy()
+    votes.insert(0, 'year', year)
+    
+    # un partido que no se presenta en un municipio no tiene fila:
+    return votes.dropna(subset=['votos'])
+
+
+def warehouse_connection(path=WAREHOUSE_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(WAREHOUSE_SCHEMA)
+    return connection
+
+
+def load_warehouse(frames, path=WAREHOUSE_PATH):
+    # frames es un diccionario {año: dataframe} como el que devuelve extract_elections;
+    # volver a cargar un año sustituye sus filas
+    with warehouse_connection(path) as connection:
+        for year, df in frames.items():
+            connection.execute('DELETE FROM municipios WHERE year = ?', (year,))
+            connection.execute('DELETE FROM resultados WHERE year = ?', (year,))
+            
+            municipios = df[['ine', 'municipio'] + [column for column in ESCRUTINIO_COLUMNS if column in df.columns]]
+            municipios.assign(year=year).to_sql('municipios', connection, if_exists='append', index=False)
+            long_results(df, year).to_sql('resultados', connection, if_exists='append', index=False)
+    connection.close()
+
+
+def query_warehouse(sql, params=None, path=WAREHOUSE_PATH):
+    import pandas as pd
+    
+    connection = sqlite3.connect(path)
+    try:
+        return pd.read_sql(sql, connection, params=params)
+    finally:
+        connection.close()
+
+
+# In[ ]:
+
+
+load_warehouse({2019: df_2019, 2021: df_2021})
+
+# votos de cada partido en toda la Comunidad y en cada año:
+query_warehouse("""
+    SELECT partido, year, SUM(votos) AS votos
+    FROM resultados
+    WHERE partido IN ('pp', 'psoe', 'mas_madrid', 'vox')
+    GROUP BY partido, year
+    ORDER BY partido, year
+""")
+
+
 # ## 2.-Contexto y análisis de los resultados
 
 # El pasado 4 de mayo de 2021 se celebraron elecciones autonómicas en la Comunidad de Madrid, donde el Partido Popular fue el partido más votado con Isabel Díaz Ayuso repitiendo como candidata.
@@ -930,27 +2025,109 @@ from plotly.offline import iplot, init_notebook_mode
 init_notebook_mode()
 
 
+# Los bloques de partidos se declaran una sola vez en `BLOQUES` y se convierten en una matriz partido x bloque con un 1 donde el partido forma parte del bloque (un partido suelto es su propio bloque). Multiplicando la matriz de votos (municipio x partido) por ella obtenemos los votos de todos los bloques en todos los municipios de una vez, y `add_bloc_shares` añade además su porcentaje sobre los votos totales y el relativo entre los bloques que se comparan. Añadir una nueva agrupación es solo añadir una entrada a `BLOQUES`.
+# 
+# Todos los totales que usamos en este apartado (votos y porcentaje de cada partido y bloque, votos totales, nulos, blancos y abstención) salen de un mismo cubo de agregados por elección, que se calcula con una sola suma por columnas. `aggregate_cube(df)` lo guarda en memoria para cada dataframe, así que las consultas siguientes son búsquedas directas. Se vuelve a calcular si cambian las filas, las columnas o los `BLOQUES`, y también cuando sube la versión del dataframe: `refresh_data_from_web` la sube con `touch_frame(df)` al cambiar valores en el sitio, y si se edita el dataframe a mano (`df.at[...] = ...`) hay que llamar a `touch_frame(df)` o a `invalidate_cube(df)`. Cuando un dataframe deja de existir su cubo se borra:
+
+# In[ ]:
+
+
+import weakref
+import numpy as np
+
+BLOQUES = {
+    'pp_psoe': ['pp', 'psoe'],
+    'otros_partidos': ['cs', 'mas_madrid', 'podemos_iu', 'vox'],
+    'derecha': ['pp', 'cs', 'vox'],
+    'izquierda': ['psoe', 'mas_madrid', 'podemos_iu'],
+}
+
+# id(df) -> (referencia débil al dataframe, clave, cubo)
+aggregate_cubes = {}
+
+
+def bloc_matrix(parties, blocs, bloques=BLOQUES):
+    membership = np.zeros((len(parties), len(blocs)))
+    position = {party: i for i, party in enumerate(parties)}
+    for j, bloc in enumerate(blocs):
+        for party in bloques.get(bloc, [bloc]):
+            if party in position:
+                membership[position[party], j] = 1
+    return membership
+
+
+def bloc_votes(df, blocs=None, bloques=BLOQUES):
+    import pandas as pd
+    
+    parties = party_columns(df)
+    blocs = list(bloques) if blocs is None else list(blocs)
+    membership = bloc_matrix(parties, blocs, bloques)
+    votes = df[parties].fillna(0).to_numpy(dtype='float64') @ membership
+    # un bloque sin ningún partido presentado en el municipio queda como NaN (y sin color en el mapa), no como 0:
+    present = df[parties].notna().to_numpy(dtype='float64') @ membership
+    votes[present == 0] = np.nan
+    
+    return pd.DataFrame(votes, index=df.index, columns=blocs)
+
+
+def add_bloc_shares(df, blocs, bloques=BLOQUES):
+    # votos, porcentaje sobre los votos totales y porcentaje relativo entre los bloques comparados:
+    votes = bloc_votes(df, blocs, bloques)
+    shares = votes.div(df['votos_totales'], axis=0)
+    relative = votes.div(votes.sum(axis=1), axis=0)
+    
+    for bloc in blocs:
+        if bloc in bloques:
+            df[bloc] = votes[bloc]
+        df[bloc + '_share'] = shares[bloc]
+        df['rel_' + bloc + '_share'] = relative[bloc]
+    return df
+
+
+def invalidate_cube(df):
+    aggregate_cubes.pop(id(df), None)
+
+
+def aggregate_cube(df, bloques=BLOQUES):
+    import pandas as pd
+    
+    # los bloques entran por contenido, así que añadir una entrada a BLOQUES también recalcula el cubo:
+    key = (df.shape, tuple(df.columns), df.attrs.get('version', 0), tuple((bloc, tuple(parties)) for bloc, parties in bloques.items()))
+    cached = aggregate_cubes.get(id(df))
+    # la referencia débil evita devolver el cubo de otro dataframe que haya ocupado el mismo id:
+    if cached is not None and cached[0]() is df and cached[1] == key:
+        return cached[2]
+    
+    counts = [column for column in ESCRUTINIO_COLUMNS if column in df.columns and not is_percentage_column(column)]
+    columns = party_columns(df) + counts
+    totals = df[columns].sum()
+    parties = party_columns(df)
+    blocs = totals[parties].fillna(0).to_numpy() @ bloc_matrix(parties, list(bloques), bloques)
+    totals = pd.concat([totals, pd.Series(blocs, index=list(bloques))])
+    
+    # como en el resto del análisis, los porcentajes son sobre los votos totales:
+    cube = pd.DataFrame({'votos': totals, 'porcentaje': totals / totals['votos_totales'] * 100})
+    frame_id = id(df)
+    reference = weakref.ref(df, lambda reference: aggregate_cubes.pop(frame_id, None))
+    aggregate_cubes[frame_id] = (reference, key, cube)
+    return cube
+
+
+def format_votes(votes):
+    return '{:,.0f}'.format(votes)+' votos'
+
+
+def format_percentage(percentage):
+    return str(round(percentage, 2))+' %'
+
+
 # In[56]:
 
 
 import plotly.graph_objects as go
 parties=['pp', 'psoe', 'cs', 'mas_madrid', 'vox', 'podemos_iu']
-final_results_2019 = [
-    df_2019['pp'].sum(), 
-    df_2019['psoe'].sum(),
-    df_2019['cs'].sum(),
-    df_2019['mas_madrid'].sum(),
-    df_2019['vox'].sum(),
-    df_2019['podemos_iu'].sum(),
-]
-final_results_2021 = [
-    df_2021['pp'].sum(), 
-    df_2021['psoe'].sum(),
-    df_2021['cs'].sum(),
-    df_2021['mas_madrid'].sum(),
-    df_2021['vox'].sum(),
-    df_2021['podemos_iu'].sum(),
-]
+final_results_2019 = aggregate_cube(df_2019).loc[parties, 'votos'].to_list()
+final_results_2021 = aggregate_cube(df_2021).loc[parties, 'votos'].to_list()
 
 fig = go.Figure(data=[
     go.Bar(name='2021', x=parties, y=final_results_2021),
@@ -968,8 +2145,8 @@ fig.show()
 
 # Dataset 2019
 
-# excluimos las columnas de 'municipio', 'link' y 'geometry':
-cols_2019 = df_2019.columns.drop(['municipio', 'link', 'geometry'])
+# excluimos las columnas de 'municipio', 'ine', 'link' y 'geometry':
+cols_2019 = df_2019.columns.drop(['municipio', 'ine', 'link', 'geometry'])
 
 # excluimos los porcentajes:
 cols_votes_2019 = [col for col in cols_2019 if '_porcentaje' not in col]
@@ -981,8 +2158,8 @@ cols_votes_2019 = [col for col in cols_votes_2019 if '_share' not in col]
 
 # Dataset 2021
 
-# excluimos las columnas de 'municipio', 'link' y 'geometry':
-cols_2021 = df_2021.columns.drop(['municipio', 'link', 'geometry'])
+# excluimos las columnas de 'municipio', 'ine', 'link' y 'geometry':
+cols_2021 = df_2021.columns.drop(['municipio', 'ine', 'link', 'geometry'])
 
 # excluimos los porcentajes:
 cols_votes_2021 = [col for col in cols_2021 if '_porcentaje' not in col]
@@ -993,29 +2170,18 @@ cols_votes_2021 = [col for col in cols_votes_2019 if '_share' not in col]
 
 
 def total_results(party, df_year):
-    total_votes = df_year[party].sum()
-    total_percentage = (df_year[party].sum()/(df_year['votos_totales'].sum()))*100
-    
-    total_votes = str("{:,}".format(total_votes)).strip('.0')+' votos'
-    total_percentage = str(round(total_percentage, 2))+' %'
+    cube = aggregate_cube(df_year)
     
-    return [total_votes, total_percentage]
+    return [format_votes(cube.at[party, 'votos']), format_percentage(cube.at[party, 'porcentaje'])]
 
 
 # In[60]:
 
 
 def difference_elections(party, df_year_1, df_year_2):
-    votes_difference = df_year_1[party].sum() - df_year_2[party].sum()
+    difference = aggregate_cube(df_year_1).loc[party] - aggregate_cube(df_year_2).loc[party]
     
-    percentage_1 = (df_year_1[party].sum()/(df_year_1['votos_totales'].sum()))*100
-    percentage_2 = (df_year_2[party].sum()/(df_year_2['votos_totales'].sum()))*100
-    percentage_difference = percentage_1 - percentage_2
-    
-    votes_difference = str("{:,}".format(votes_difference)).strip('.0')+' votos'
-    percentage_difference = str(round(percentage_difference, 2))+' %'
-    
-    return [votes_difference, percentage_difference]
+    return [format_votes(difference['votos']), format_percentage(difference['porcentaje'])]
 
 
 # #### **Partido Popular**
@@ -1023,9 +2189,9 @@ def difference_elections(party, df_year_1, df_year_2):
 # In[61]:
 
 
-print('PP_2019: '+ total_results('pp', df_2019)[0] +' / '+ total_results('pp', df_2019)[1])
-print('PP_2021: '+ total_results('pp', df_2021)[0] +' / '+ total_results('pp', df_2021)[1])
-print('PP_difference: '+ difference_elections('pp', df_2021, df_2019)[0] +' / '+ difference_elections('pp', df_2021, df_2019)[1])
+print('PP_2019: '+ ' / '.join(total_results('pp', df_2019)))
+print('PP_2021: '+ ' / '.join(total_results('pp', df_2021)))
+print('PP_difference: '+ ' / '.join(difference_elections('pp', df_2021, df_2019)))
 
 
 # #### **PSOE**
@@ -1033,9 +2199,9 @@ print('PP_difference: '+ difference_elections('pp', df_2021, df_2019)[0] +' / '+
 # In[62]:
 
 
-print('PSOE_2019: '+ total_results('psoe', df_2019)[0] +' / '+ total_results('psoe', df_2019)[1])
-print('PSOE_2021: '+ total_results('psoe', df_2021)[0] +' / '+ total_results('psoe', df_2021)[1])
-print('PSOE_difference: '+ difference_elections('psoe', df_2021, df_2019)[0] +' / '+ difference_elections('psoe', df_2021, df_2019)[1])
+print('PSOE_2019: '+ ' / '.join(total_results('psoe', df_2019)))
+print('PSOE_2021: '+ ' / '.join(total_results('psoe', df_2021)))
+print('PSOE_difference: '+ ' / '.join(difference_elections('psoe', df_2021, df_2019)))
 
 
 # #### **Ciudadanos**
@@ -1043,9 +2209,9 @@ print('PSOE_difference: '+ difference_elections('psoe', df_2021, df_2019)[0] +'
 # In[63]:
 
 
-print('CS_2019: '+ total_results('cs', df_2019)[0] +' / '+ total_results('cs', df_2019)[1])
-print('CS_2021: '+ total_results('cs', df_2021)[0] +' / '+ total_results('cs', df_2021)[1])
-print('CS_difference: '+ difference_elections('cs', df_2021, df_2019)[0] +' / '+ difference_elections('cs', df_2021, df_2019)[1])
+print('CS_2019: '+ ' / '.join(total_results('cs', df_2019)))
+print('CS_2021: '+ ' / '.join(total_results('cs', df_2021)))
+print('CS_difference: '+ ' / '.join(difference_elections('cs', df_2021, df_2019)))
 
 
 # #### **Más Madrid**
@@ -1053,9 +2219,9 @@ print('CS_difference: '+ difference_elections('cs', df_2021, df_2019)[0] +' / '+
 # In[64]:
 
 
-print('MAS_MADRID_2019: '+ total_results('mas_madrid', df_2019)[0] +' / '+ total_results('mas_madrid', df_2019)[1])
-print('MAS_MADRID_2021: '+ total_results('mas_madrid', df_2021)[0] +' / '+ total_results('mas_madrid', df_2021)[1])
-print('MAS_MADRID_difference: '+ difference_elections('mas_madrid', df_2021, df_2019)[0] +' / '+ difference_elections('mas_madrid', df_2021, df_2019)[1])
+print('MAS_MADRID_2019: '+ ' / '.join(total_results('mas_madrid', df_2019)))
+print('MAS_MADRID_2021: '+ ' / '.join(total_results('mas_madrid', df_2021)))
+print('MAS_MADRID_difference: '+ ' / '.join(difference_elections('mas_madrid', df_2021, df_2019)))
 
 
 # #### **PODEMOS-IU**
@@ -1063,9 +2229,9 @@ print('MAS_MADRID_difference: '+ difference_elections('mas_madrid', df_2021, df_
 # In[65]:
 
 
-print('PODEMOS_IU_2019: '+ total_results('podemos_iu', df_2019)[0] +' / '+ total_results('podemos_iu', df_2019)[1])
-print('PODEMOS_IU_2021: '+ total_results('podemos_iu', df_2021)[0] +' / '+ total_results('podemos_iu', df_2021)[1])
-print('PODEMOS_IU_difference: '+ difference_elections('podemos_iu', df_2021, df_2019)[0] +' / '+ difference_elections('podemos_iu', df_2021, df_2019)[1])
+print('PODEMOS_IU_2019: '+ ' / '.join(total_results('podemos_iu', df_2019)))
+print('PODEMOS_IU_2021: '+ ' / '.join(total_results('podemos_iu', df_2021)))
+print('PODEMOS_IU_difference: '+ ' / '.join(difference_elections('podemos_iu', df_2021, df_2019)))
 
 
 # #### **Vox**
@@ -1073,14 +2239,165 @@ print('PODEMOS_IU_difference: '+ difference_elections('podemos_iu', df_2021, df_
 # In[66]:
 
 
-print('VOX_2019: '+ total_results('vox', df_2019)[0] +' / '+ total_results('vox', df_2019)[1])
-print('VOX_2021: '+ total_results('vox', df_2021)[0] +' / '+ total_results('vox', df_2021)[1])
-print('VOX_difference: '+ difference_elections('vox', df_2021, df_2019)[0] +' / '+ difference_elections('vox', df_2021, df_2019)[1])
+print('VOX_2019: '+ ' / '.join(total_results('vox', df_2019)))
+print('VOX_2021: '+ ' / '.join(total_results('vox', df_2021)))
+print('VOX_difference: '+ ' / '.join(difference_elections('vox', df_2021, df_2019)))
 
 
 # Vemos claramente cómo el PP es el partido que más crece en número de votos (+910,607 votos / 22.33%), frente a Cs que es el que más disminuye su apoyo electoral (-501,023 votos / -15.84%) pasando de 631,117 votos (19.39%) a 130,094 votos (3.55%), lo que implica no llegar al 5% mínimo para obtener representación parlamentaria. Otro partido que pierde apoyos es el PSOE (-272,236 votos / -10.49%).
 # 
-# El resto de partidos aumenta sus apoyos: Más Madrid pasa de 474,725 votos (14.59%) a 618,285 votos (16.85%), lo que supone un incremento de 142,439 votos (2.27%), consiguiendo dar el sorpaso al PSOE dentro del bloque de la izquierda; le sigue Podemos-IU de 181,242 votos (5.57%) a 262,45 votos (7.15%), lo que supone un crecimiento en 81,208 votos (1.59%). Por último, Vox es el partido de los que obtiene representación que menos crece: 288,313 votos (8.86%) en 2019 a 333,447 votos (9.09%) en 2021, lo que supone un aumento de 44,824 votos (0.24%).
+# El resto de partidos aumenta sus apoyos: Más Madrid pasa de 474,725 votos (14.59%) a 618,285 votos (16.85%), lo que supone un incremento de 142,439 votos (2.27%), consiguiendo dar el sorpaso al PSOE dentro del bloque de la izquierda; le sigue Podemos-IU de 181,242 votos (5.57%) a 262,450 votos (7.15%), lo que supone un crecimiento en 81,208 votos (1.59%). Por último, Vox es el partido de los que obtiene representación que menos crece: 288,313 votos (8.86%) en 2019 a 333,447 votos (9.09%) en 2021, lo que supone un aumento de 44,824 votos (0.24%).
+
+# Con los totales de cada partido podemos calcular también el reparto de escaños: los partidos que no llegan al 5% de los votos válidos (votos a candidaturas más votos en blanco) quedan fuera, y los escaños se reparten con la ley D'Hondt. `dhondt` acepta un vector de votos o una matriz con un escenario por fila, de forma que sirve igual para proyectar miles de escenarios en una sola llamada; para no ocupar demasiada memoria con los cocientes procesa los escenarios por bloques de `chunk` filas:
+
+# In[ ]:
+
+
+ESCANOS = {2019: 132, 2021: 136}
+UMBRAL = 0.05
+
+
+def dhondt(votes, seats, blank=0, threshold=UMBRAL, chunk=4096):
+    import numpy as np
+    
+    votes = np.asarray(votes, dtype='float64')
+    single = votes.ndim == 1
+    votes = np.atleast_2d(votes)
+    blank = np.broadcast_to(np.asarray(blank, dtype='float64'), votes.shape[:1])
+    
+    # fuera del reparto los partidos por debajo del umbral sobre los votos válidos:
+    valid = votes.sum(axis=1) + blank
+    eligible = np.where(votes >= threshold * valid[:, None], votes, 0)
+    
+    divisors = np.arange(1, seats + 1, dtype='float64')
+    result = np.zeros(votes.shape, dtype='int64')
+    for start in range(0, len(votes), chunk):
+        block = eligible[start:start + chunk]
+        # solo entran en los cocientes los partidos que superan el umbral en algún escenario del bloque:
+        columns = np.flatnonzero((block > 0).any(axis=0))
+        if len(columns) == 0:
+            continue
+        # cocientes votos / 1, 2, ..., seats de cada partido; los escaños van a los `seats` mayores
+        quotients = (block[:, columns, None] / divisors).reshape(len(block), -1)
+        top = np.argpartition(-quotients, seats - 1, axis=1)[:, :seats]
+        parties = columns[top // seats].ravel()
+        rows = np.repeat(np.arange(len(block)), seats)
+        # un escenario sin ningún partido por encima del umbral no reparte escaños:
+        awarded = np.take_along_axis(quotients, top, axis=1).ravel() > 0
+        np.add.at(result[start:start + chunk], (rows[awarded], parties[awarded]), 1)
+    
+    return result[0] if single else result
+
+
+def seat_projection(df, year, seats=None, threshold=UMBRAL):
+    import pandas as pd
+    
+    seats = ESCANOS[year] if seats is None else seats
+    cube = aggregate_cube(df)
+    parties = party_columns(df)
+    allocation = dhondt(cube.loc[parties, 'votos'].fillna(0), seats, cube.at['votos_blancos', 'votos'], threshold)
+    
+    return pd.Series(allocation, index=parties, name=year).loc[lambda allocation: allocation > 0].sort_values(ascending=False)
+
+
+# In[ ]:
+
+
+pd.concat([seat_projection(df_2019, 2019), seat_projection(df_2021, 2021)], axis=1).fillna(0).astype(int)
+
+
+# Para ver cómo de robusto es el resultado simulamos escenarios a partir de los resultados de cada municipio. En cada simulación se mueve el porcentaje de cada partido en cada municipio (`swing`, en tanto por uno) y la participación (`turnout`), se suman los votos y se reparten los escaños con `dhondt`:
+# 
+# * con `noise='uniforme'` cada partido y municipio varía de forma independiente entre -swing y +swing,
+# * con `noise='correlacionada'` cada partido varía lo mismo en todos los municipios (entre -swing y +swing) más un ruido local de desviación `local`.
+# 
+# Las simulaciones se hacen por lotes de `batch` escenarios con NumPy y se reparten en tareas de `task_draws` escenarios entre varios procesos. Cada tarea tiene su propia semilla derivada de `seed` (`SeedSequence.spawn`), así que el resultado es el mismo con cualquier número de procesos. Devuelve la probabilidad de cada número de escaños por partido y la probabilidad de mayoría absoluta de cada partido y bloque. Los procesos heredan las funciones del notebook, así que se crean con `fork`; donde no está disponible (Windows) la simulación se hace en el propio proceso.
+# 
+# Cada 20.000 simulaciones cuestan unos 2-3 segundos por núcleo. En el libro usamos 50.000 para no pasar del tiempo máximo por celda; para estimaciones más finas basta con pasar, por ejemplo, `draws=1000000`:
+
+# In[ ]:
+
+
+def simulate_batch(shares, valid, blank, membership, seats, draws, seed, swing, noise, local, turnout, batch, threshold):
+    import numpy as np
+    
+    rng = np.random.default_rng(seed)
+    n, p = shares.shape
+    histogram = np.zeros((p, seats + 1), dtype='int64')
+    majorities = np.zeros(p + membership.shape[1], dtype='int64')
+    
+    for start in range(0, draws, batch):
+        size = min(batch, draws - start)
+        if noise == 'uniforme':
+            delta = rng.uniform(-swing, swing, (size, n, p))
+        elif noise == 'correlacionada':
+            delta = rng.uniform(-swing, swing, (size, 1, p)) + rng.normal(0, local, (size, n, p))
+        else:
+            raise ValueError("noise debe ser 'uniforme' o 'correlacionada'")
+        
+        # lo que gana un partido lo pierden los demás: el total de votos a candidaturas de cada municipio no cambia
+        simulated = np.clip(shares + delta, 0, None)
+        simulated *= (shares.sum(axis=1) / np.maximum(simulated.sum(axis=2), 1e-12))[:, :, None]
+        factor = rng.uniform(1 - turnout, 1 + turnout, (size, n))
+        
+        party_votes = np.einsum('snp,sn->sp', simulated, valid * factor)
+        blank_votes = (blank * factor).sum(axis=1)
+        allocation = dhondt(party_votes, seats, blank_votes, threshold)
+        
+        np.add.at(histogram, (np.arange(p), allocation), 1)
+        majorities += (np.hstack([allocation, allocation @ membership]) >= seats // 2 + 1).sum(axis=0)
+    
+    return histogram, majorities
+
+
+def simulate_seats(df, year, draws=50000, swing=0.02, noise='uniforme', local=0.01, turnout=0.05,
+                   seed=2021, workers=None, task_draws=50000, batch=1000, threshold=UMBRAL, bloques=BLOQUES):
+    import multiprocessing
+    import numpy as np
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    
+    parties = party_columns(df)
+    votes = df[parties].fillna(0).to_numpy(dtype='float64')
+    blank = df['votos_blancos'].fillna(0).to_numpy(dtype='float64')
+    valid = votes.sum(axis=1) + blank
+    shares = votes / np.where(valid > 0, valid, 1)[:, None]
+    membership = bloc_matrix(parties, list(bloques), bloques).astype('int64')
+    seats = ESCANOS[year]
+    
+    sizes = [min(task_draws, draws - start) for start in range(0, draws, task_draws)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = len(sizes)
+    args = (
+        [shares] * tasks, [valid] * tasks, [blank] * tasks, [membership] * tasks, [seats] * tasks, sizes, seeds,
+        [swing] * tasks, [noise] * tasks, [local] * tasks, [turnout] * tasks, [batch] * tasks, [threshold] * tasks,
+    )
+    # simulate_batch está definida en el notebook: solo los procesos creados con fork la conocen
+    if workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        results = list(map(simulate_batch, *args))
+    else:
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            results = list(executor.map(simulate_batch, *args))
+    
+    histogram = sum(result[0] for result in results)
+    majorities = sum(result[1] for result in results)
+    
+    distribution = pd.DataFrame(histogram / draws, index=parties, columns=range(seats + 1))
+    # solo los partidos que consiguen algún escaño en alguna simulación:
+    distribution = distribution[distribution[0] < 1]
+    majority = pd.Series(majorities / draws, index=parties + list(bloques), name='mayoria')
+    
+    return distribution, majority
+
+
+# In[ ]:
+
+
+# ¿qué probabilidad tenía el PP de conseguir la mayoría absoluta (69 escaños) con variaciones de ±2%?
+distribution, majority = simulate_seats(df_2021, 2021, draws=50000, swing=0.02, noise='correlacionada')
+majority[['pp', 'derecha', 'izquierda']]
+
 
 # ### 2.2.-Análisis de la distribución del voto
 
@@ -1095,31 +2412,17 @@ print('VOX_difference: '+ difference_elections('vox', df_2021, df_2019)[0] +' /
 # In[67]:
 
 
+# votos y porcentajes de cada bloque (BLOQUES) en cada elección:
+cube_2019 = aggregate_cube(df_2019)
+cube_2021 = aggregate_cube(df_2021)
+
 # 2019:
-pp_2019 = df_2019['pp'].sum()
-psoe_2019 = df_2019['psoe'].sum()
-cs_2019 = df_2019['cs'].sum()
-mas_madrid_2019 = df_2019['mas_madrid'].sum()
-podemos_iu_2019 = df_2019['podemos_iu'].sum()
-vox_2019 = df_2019['podemos_iu'].sum()
-
-pp_psoe_2019 = pp_2019 + psoe_2019
-otros_partidos_2019 = cs_2019 + mas_madrid_2019 + podemos_iu_2019 + vox_2019
-pp_psoe_percentage_2019 = (pp_psoe_2019/df_2019['votos_totales'].sum())*100
-otros_partidos_percentage_2019 = (otros_partidos_2019/df_2019['votos_totales'].sum())*100
+pp_psoe_2019, pp_psoe_percentage_2019 = cube_2019.loc['pp_psoe']
+otros_partidos_2019, otros_partidos_percentage_2019 = cube_2019.loc['otros_partidos']
 
 # 2021:
-pp_2021 = df_2021['pp'].sum()
-psoe_2021 = df_2021['psoe'].sum()
-cs_2021 = df_2021['cs'].sum()
-mas_madrid_2021 = df_2021['mas_madrid'].sum()
-podemos_iu_2021 = df_2021['podemos_iu'].sum()
-vox_2021 = df_2021['podemos_iu'].sum()
-
-pp_psoe_2021 = pp_2021 + psoe_2021
-otros_partidos_2021 = cs_2021 + mas_madrid_2021 + podemos_iu_2021 + vox_2021
-pp_psoe_percentage_2021 = (pp_psoe_2021/df_2021['votos_totales'].sum())*100
-otros_partidos_percentage_2021 = (otros_partidos_2021/df_2021['votos_totales'].sum())*100
+pp_psoe_2021, pp_psoe_percentage_2021 = cube_2021.loc['pp_psoe']
+otros_partidos_2021, otros_partidos_percentage_2021 = cube_2021.loc['otros_partidos']
 
 # Diferencia entre 2019 y 2021
 ## diferencia de votos:
@@ -1157,21 +2460,21 @@ fig.show()
 
 
 # 2019
-pp_psoe_2019 = str("{:,}".format(pp_psoe_2019)).strip('.0')+' votos'
+pp_psoe_2019 = format_votes(pp_psoe_2019)
 pp_psoe_percentage_2019 = str(round(pp_psoe_percentage_2019, 2))+' %'
-otros_partidos_2019 = str("{:,}".format(otros_partidos_2019)).strip('.0')+' votos'
+otros_partidos_2019 = format_votes(otros_partidos_2019)
 otros_partidos_percentage_2019 = str(round(otros_partidos_percentage_2019, 2))+' %'
 
 # 2021
-pp_psoe_2021 = str("{:,}".format(pp_psoe_2021)).strip('.0')+' votos'
+pp_psoe_2021 = format_votes(pp_psoe_2021)
 pp_psoe_percentage_2021 = str(round(pp_psoe_percentage_2021, 2))+' %'
-otros_partidos_2021 = str("{:,}".format(otros_partidos_2021)).strip('.0')+' votos'
+otros_partidos_2021 = format_votes(otros_partidos_2021)
 otros_partidos_percentage_2021 = str(round(otros_partidos_percentage_2021, 2))+' %'
 
 # Diferencia entre 2019 y 2021
 ## diferencia de votos:
-pp_psoe_vote_diff = str("{:,}".format(pp_psoe_vote_diff)).strip('.0')+' votos'
-otros_partidos_vote_diff = str("{:,}".format(otros_partidos_vote_diff)).strip('.0')+' votos'
+pp_psoe_vote_diff = format_votes(pp_psoe_vote_diff)
+otros_partidos_vote_diff = format_votes(otros_partidos_vote_diff)
 ## diferencia de porcentajes:
 pp_psoe_per_diff = str(round(pp_psoe_per_diff, 2))+' %'
 otros_per_diff = str(round(otros_per_diff, 2))+' %'
@@ -1195,7 +2498,7 @@ print('OTROS_PARTIDOS_DIFF: '+ otros_partidos_vote_diff +' / '+ otros_per_diff)
 
 # Podemos ver que de las elecciones de 2019 a las de 2021 se produce una reconfiguración de los partidos tradicionales del Régimen del 78 (PP-PSOE) al pasar de 1,606,519 votos (49.36%) en 2019 a 2,244,890 votos (61.2%) en 2021, lo que supone un aumento de 638,371 votos (11.84%) liderado por el espectacular aumento del PP.
 # 
-# Por otro lado, los partidos al margen de PP-PSOE pasan de acumular 1,468,326 votos (45.11%) en 2019 a 1,273,279 votos (34.71%) en 2021, lo que supone una disminución de 195,047 votos (-10.4%). El principal responsable de esta caída está en el desplome de Cs, ya que como vimos Más Madrid, Podemos-IU y Vox crecieron en apoyos. 
+# Por otro lado, los partidos al margen de PP-PSOE pasan de acumular 1,575,397 votos (48.4%) en 2019 a 1,344,276 votos (36.65%) en 2021, lo que supone una disminución de 231,121 votos (-11.75%). Estas cifras incluyen ya los votos de Vox; en versiones anteriores de este análisis se sumaban por error los de Podemos-IU en su lugar, y por eso eran más bajas. El principal responsable de esta caída está en el desplome de Cs, ya que como vimos Más Madrid, Podemos-IU y Vox crecieron en apoyos. 
 # 
 # Se podría decir que bastante del apoyo que obtuvo Cs en 2019 pasó al PP en 2021 y que parte del apoyo del PSOE pudo haberse repartido tanto hacia la izquierda (principalmente Más Madrid) como hacia la derecha (principalmente PP).
 
@@ -1204,40 +2507,23 @@ print('OTROS_PARTIDOS_DIFF: '+ otros_partidos_vote_diff +' / '+ otros_per_diff)
 # In[72]:
 
 
-# Partidos
-## 2019
-pp_2019 = df_2019['pp'].sum()
-psoe_2019 = df_2019['psoe'].sum()
-cs_2019 = df_2019['cs'].sum()
-mas_madrid_2019 = df_2019['mas_madrid'].sum()
-podemos_iu_2019 = df_2019['podemos_iu'].sum()
-vox_2019 = df_2019['podemos_iu'].sum()
-## 2021
-pp_2021 = df_2021['pp'].sum()
-psoe_2021 = df_2021['psoe'].sum()
-cs_2021 = df_2021['cs'].sum()
-mas_madrid_2021 = df_2021['mas_madrid'].sum()
-podemos_iu_2021 = df_2021['podemos_iu'].sum()
-vox_2021 = df_2021['podemos_iu'].sum()
+cube_2019 = aggregate_cube(df_2019)
+cube_2021 = aggregate_cube(df_2021)
 
 # 2019:
 ## Derecha:
-right_votes_2019 = pp_2019 + cs_2019 + vox_2019
-right_percentage_2019 = (right_votes_2019/df_2019['votos_totales'].sum())*100
+right_votes_2019, right_percentage_2019 = cube_2019.loc['derecha']
 ## Izquierda:
-left_votes_2019 = psoe_2019 + mas_madrid_2019 + podemos_iu_2019
-left_percentage_2019 = (left_votes_2019/df_2019['votos_totales'].sum())*100
+left_votes_2019, left_percentage_2019 = cube_2019.loc['izquierda']
 ## Derecha-Izquierda diferencia:
 right_left_vote_diff_2019 = right_votes_2019 - left_votes_2019
 right_left_perc_diff_2019 = right_percentage_2019 - left_percentage_2019
 
 # 2021:
 ## Derecha:
-right_votes_2021 = pp_2021 + cs_2021 + vox_2021
-right_percentage_2021 = (right_votes_2021/df_2021['votos_totales'].sum())*100
+right_votes_2021, right_percentage_2021 = cube_2021.loc['derecha']
 ## Izquierda:
-left_votes_2021 = psoe_2021 + mas_madrid_2021 + podemos_iu_2021
-left_percentage_2021 = (left_votes_2021/df_2021['votos_totales'].sum())*100
+left_votes_2021, left_percentage_2021 = cube_2021.loc['izquierda']
 ## Derecha-Izquierda diferencia:
 right_left_vote_diff_2021 = right_votes_2021 - left_votes_2021
 right_left_perc_diff_2021 = right_percentage_2021 - left_percentage_2021
@@ -1279,30 +2565,30 @@ fig.show()
 
 # 2019
 ## Derecha:
-right_votes_2019 = str("{:,}".format(right_votes_2019)).strip('.0')+' votos'
+right_votes_2019 = format_votes(right_votes_2019)
 right_percentage_2019 = str(round(right_percentage_2019, 2))+' %'
 ## Izquierda:
-left_votes_2019 = str("{:,}".format(left_votes_2019)).strip('.0')+' votos'
+left_votes_2019 = format_votes(left_votes_2019)
 left_percentage_2019 = str(round(left_percentage_2019, 2))+' %'
 ## Derecha-Izquierda diferencia
-right_left_vote_diff_2019 = str("{:,}".format(right_left_vote_diff_2019)).strip('.0')+' votos'
+right_left_vote_diff_2019 = format_votes(right_left_vote_diff_2019)
 right_left_perc_diff_2019 = str(round(right_left_perc_diff_2019, 2))+' %'
 
 # 2021
 ## Derecha:
-right_votes_2021 = str("{:,}".format(right_votes_2021)).strip('.0')+' votos'
+right_votes_2021 = format_votes(right_votes_2021)
 right_percentage_2021 = str(round(right_percentage_2021, 2))+' %'
 ## Izquierda:
-left_votes_2021 = str("{:,}".format(left_votes_2021)).strip('.0')+' votos'
+left_votes_2021 = format_votes(left_votes_2021)
 left_percentage_2021 = str(round(left_percentage_2021, 2))+' %'
 ## Derecha-Izquierda diferencia
-right_left_vote_diff_2021 = str("{:,}".format(right_left_vote_diff_2021)).strip('.0')+' votos'
+right_left_vote_diff_2021 = format_votes(right_left_vote_diff_2021)
 right_left_perc_diff_2021 = str(round(right_left_perc_diff_2021, 2))+' %'
 
 # Diferencia entre 2019-2021
 ## diferencia de votos
-right_vote_diff = str("{:,}".format(right_vote_diff)).strip('.0')+' votos'
-left_vote_diff = str("{:,}".format(left_vote_diff)).strip('.0')+' votos'
+right_vote_diff = format_votes(right_vote_diff)
+left_vote_diff = format_votes(left_vote_diff)
 ## diferencia de porcentajes
 right_percentage_diff = str(round(right_percentage_diff, 2))+' %'
 left_percentage_diff = str(round(left_percentage_diff, 2))+' %'
@@ -1331,7 +2617,7 @@ print('RIGHT_LEFT_DIFF_2019: '+ right_left_vote_diff_2019 +' / '+ right_left_per
 print('RIGHT_LEFT_DIFF_2021: '+ right_left_vote_diff_2021 +' / '+ right_left_perc_diff_2021)
 
 
-# Podemos decir que el bloque de la derecha aumenta en 490,792 votos (8.07%) en 2021, mientras que el bloque de la izquierda cae en 47,468 votos (-6.63%). En 2019, la derecha representaba el 47.11% (1,533,343 votos) mientras que la izquierda un 47.36% (1,541,502 votos), prácticamente empatados con una diferencia del 0.25% (8,159 votos) a favor de la izquierda. En cambio en el 2021 la derecha representa un 55.18% (2,024,135 votos) frente al 40.73% (1,494,034 votos), una diferencia del 14.45% (530,101 votos) a favor de la derecha.
+# Podemos decir que el bloque de la derecha aumenta en 454,718 votos (6.72%) en 2021, mientras que el bloque de la izquierda cae en 47,468 votos (-6.63%). En 2019, la derecha representaba el 50.4% (1,640,414 votos) mientras que la izquierda un 47.36% (1,541,502 votos), una diferencia del 3.04% (98,912 votos) a favor de la derecha. En el 2021 la derecha representa un 57.12% (2,095,132 votos) frente al 40.73% (1,494,034 votos), y la diferencia a favor de la derecha se amplía al 16.39% (601,098 votos). Como en el apartado anterior, estas cifras ya cuentan los votos de Vox en el bloque de la derecha (antes se sumaban los de Podemos-IU en su lugar, lo que daba un empate aparente en 2019).
 # 
 # El aumento de la derecha está liderado por el crecimiento del PP, pero se ve atenuado por la fuerte caída de Cs y el poco crecimiento de Vox. Mientras tanto en la izquierda la caída se debe al desplome del PSOE principalmente, pero atenuado por los crecimientos de Más Madrid y Podemos-IU.
 
@@ -1341,15 +2627,54 @@ print('RIGHT_LEFT_DIFF_2021: '+ right_left_vote_diff_2021 +' / '+ right_left_per
 # 
 # Para la construcción de mapas interactivos que permitieran mostrar la distribución del voto en cada municipio se ha utilizado la librería BokehJS y los datos geoespaciales de nuestros dataframes (columna 'geometry').
 
+# Para contar en cuántos municipios un partido (o bloque) supera a otro calculamos de una vez, para todos los años, la matriz de enfrentamientos: `wins.loc[(año, partido_1), partido_2]` es el número de municipios en los que partido_1 obtiene más votos que partido_2. `winners` recoge además el partido más votado de cada municipio, el segundo y la diferencia entre ambos:
+
 # In[78]:
 
 
-# funcion que te devuelve nº de municipios donde gana un partido (party_1) sobre otro (party_2):
-def won_municipalities(party_1, party_2, df):
-    municipalities = []
-    municipalities = df['municipio'][df[party_1] > df[party_2]].count()
+def winner_matrix(frames, contenders=None, bloques=BLOQUES):
+    import numpy as np
+    import pandas as pd
+    
+    wins = []
+    winners = []
+    for year, df in frames.items():
+        parties = party_columns(df)
+        names = parties + list(bloques) if contenders is None else list(contenders)
+        
+        # votes[:, i, None] > votes[:, None, j] compara todos los pares en cada municipio:
+        votes = bloc_votes(df, names, bloques).to_numpy()
+        # como en won_municipalities, no se gana a quien no se presenta en el municipio (ni quien no se presenta gana):
+        present = ~np.isnan(votes)
+        counts = ((votes[:, :, None] > votes[:, None, :]) & present[:, :, None] & present[:, None, :]).sum(axis=0)
+        index = pd.MultiIndex.from_product([[year], names], names=['year', 'partido'])
+        wins.append(pd.DataFrame(counts, index=index, columns=names))
+        
+        # los partidos que no se presentan quedan los últimos al ordenar, y sin segundo el margen queda vacío:
+        party_votes = df[parties].to_numpy(dtype='float64', na_value=np.nan)
+        order = np.argsort(np.nan_to_num(party_votes, nan=-np.inf), axis=1)
+        rows = np.arange(len(df))
+        first = party_votes[rows, order[:, -1]]
+        second = party_votes[rows, order[:, -2]]
+        winners.append(pd.DataFrame({
+            'year': year,
+            'municipio': df['municipio'].to_numpy(),
+            'ganador': np.where(np.isnan(first), None, np.array(parties, dtype=object)[order[:, -1]]),
+            'segundo': np.where(np.isnan(second), None, np.array(parties, dtype=object)[order[:, -2]]),
+            'margen': first - second,
+            'margen_porcentaje': (first - second) / df['votos_totales'].to_numpy() * 100,
+            'empate': first == second,
+        }))
     
-    return municipalities
+    # los partidos que no se presentan un año quedan vacíos en la matriz de ese año:
+    return pd.concat(wins).astype('Int64'), pd.concat(winners, ignore_index=True)
+
+
+# In[ ]:
+
+
+wins, winners = winner_matrix({2019: df_2019, 2021: df_2021})
+winners.groupby('year')['ganador'].value_counts()
 
 
 # **PP (vs) PSOE** 
@@ -1358,10 +2683,7 @@ def won_municipalities(party_1, party_2, df):
 
 
 # añado nuevas columnas
-df_2019["pp_share"] = df_2019["pp"] / df_2019["votos_totales"]
-df_2019["rel_pp_share"] = df_2019["pp"] / (df_2019["pp"]+df_2019["psoe"])
-df_2019["psoe_share"] = df_2019["psoe"] / df_2019["votos_totales"]
-df_2019["rel_psoe_share"] = df_2019["psoe"] / (df_2019["pp"]+df_2019["psoe"])
+df_2019 = add_bloc_shares(df_2019, ['pp', 'psoe'])
 
 
 # In[80]:
@@ -1379,8 +2701,7 @@ from bokeh.palettes import brewer
 output_notebook()
 import json
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1399,17 +2720,13 @@ show(p)
 
 
 # añado nuevas columnas
-df_2021["pp_share"] = df_2021["pp"] / df_2021["votos_totales"]
-df_2021["rel_pp_share"] = df_2021["pp"] / (df_2021["pp"]+df_2021["psoe"])
-df_2021["psoe_share"] = df_2021["psoe"] / df_2021["votos_totales"]
-df_2021["rel_psoe_share"] = df_2021["psoe"] / (df_2021["pp"]+df_2021["psoe"])
+df_2021 = add_bloc_shares(df_2021, ['pp', 'psoe'])
 
 
 # In[82]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1428,28 +2745,28 @@ show(p)
 
 
 # municipios ganados por el PP al PSOE en 2019
-won_municipalities('pp', 'psoe', df_2019)
+wins.loc[(2019, 'pp'), 'psoe']
 
 
 # In[84]:
 
 
 # municipios ganados por el PSOE al PP en 2019
-won_municipalities('psoe', 'pp', df_2019)
+wins.loc[(2019, 'psoe'), 'pp']
 
 
 # In[85]:
 
 
 # municipios ganados por el PP al PSOE en 2021
-won_municipalities('pp', 'psoe', df_2021)
+wins.loc[(2021, 'pp'), 'psoe']
 
 
 # In[86]:
 
 
 # municipios ganados por el PSOE al PP en 2021
-won_municipalities('psoe', 'pp', df_2021)
+wins.loc[(2021, 'psoe'), 'pp']
 
 
 # Se puede apreciar la gran debacle del PSOE al pasar de 114 municipios en los que obtuvo más apoyos sobre el PP en 2019 a solo 2 en 2021, mientras que el PP pasa de 63 municipios en 2019 a 176 en 2021. En el municipio de Navarredonda y San Mamés se obtiene un empate técnico entre ambos partidos.
@@ -1461,30 +2778,17 @@ won_municipalities('psoe', 'pp', df_2021)
 
 # 2019
 df_2019 = df_2019.fillna(0)
-df_2019['pp_psoe'] = df_2019["pp"] + df_2019["psoe"]
-df_2019['otros_partidos'] = df_2019["mas_madrid"] + df_2019["cs"] + df_2019["podemos_iu"] + df_2019["vox"]
-
-df_2019["pp_psoe_share"] = df_2019["pp_psoe"] / df_2019["votos_totales"]
-df_2019["rel_pp_psoe_share"] = df_2019["pp_psoe"] / (df_2019["pp"]+df_2019["otros_partidos"])
-df_2019["otros_partidos_share"] = df_2019["otros_partidos"] / df_2019["votos_totales"]
-df_2019["rel_otros_partidos_share"] = df_2019["otros_partidos"] / (df_2019["pp_psoe"]+df_2019["otros_partidos"])
+df_2019 = add_bloc_shares(df_2019, ['pp_psoe', 'otros_partidos'])
 
 # 2021
 df_2021 = df_2021.fillna(0)
-df_2021['pp_psoe'] = df_2021["pp"] + df_2021["psoe"]
-df_2021['otros_partidos'] = df_2021["mas_madrid"] + df_2021["cs"] + df_2021["podemos_iu"] + df_2021["vox"]
-
-df_2021["pp_psoe_share"] = df_2021["pp_psoe"] / df_2021["votos_totales"]
-df_2021["rel_pp_psoe_share"] = df_2021["pp_psoe"] / (df_2021["pp"]+df_2021["otros_partidos"])
-df_2021["otros_partidos_share"] = df_2021["otros_partidos"] / df_2021["votos_totales"]
-df_2021["rel_otros_partidos_share"] = df_2021["otros_partidos"] / (df_2021["pp_psoe"]+df_2021["otros_partidos"])
+df_2021 = add_bloc_shares(df_2021, ['pp_psoe', 'otros_partidos'])
 
 
 # In[88]:
 
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1502,8 +2806,7 @@ show(p)
 # In[89]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1522,28 +2825,28 @@ show(p)
 
 
 # municipios ganados por PP-PSOE al resto de partidos en 2019
-won_municipalities('pp_psoe', 'otros_partidos', df_2019)
+wins.loc[(2019, 'pp_psoe'), 'otros_partidos']
 
 
 # In[91]:
 
 
 # municipios ganados por el resto de partidos a PP-PSOE en 2019
-won_municipalities('otros_partidos', 'pp_psoe', df_2019)
+wins.loc[(2019, 'otros_partidos'), 'pp_psoe']
 
 
 # In[92]:
 
 
 # municipios ganados por PP-PSOE al resto de partidos en 2021
-won_municipalities('pp_psoe', 'otros_partidos', df_2021)
+wins.loc[(2021, 'pp_psoe'), 'otros_partidos']
 
 
 # In[93]:
 
 
 # municipios ganados por el resto de partidos a PP-PSOE en 2021
-won_municipalities('otros_partidos', 'pp_psoe', df_2021)
+wins.loc[(2021, 'otros_partidos'), 'pp_psoe']
 
 
 # Se ve la reconfiguración del eje PP-PSOE frente a otros partidos (Cs, Vox, Podemos-IU y Más Madrid), ya que se pasa de 121 municipios donde obtienen mayoría frente a 58 a 176 municipios frente a 3.
@@ -1554,29 +2857,16 @@ won_municipalities('otros_partidos', 'pp_psoe', df_2021)
 
 
 # 2019
-df_2019['derecha'] = df_2019["pp"] + df_2019["cs"] + df_2019["vox"]
-df_2019['izquierda'] = df_2019["psoe"]+ df_2019["mas_madrid"] + df_2019["podemos_iu"] 
-
-df_2019["derecha_share"] = df_2019["derecha"] / df_2019["votos_totales"]
-df_2019["rel_derecha_share"] = df_2019["derecha"] / (df_2019["derecha"]+df_2019["izquierda"])
-df_2019["izquierda_share"] = df_2019["izquierda"] / df_2019["votos_totales"]
-df_2019["rel_izquierda_share"] = df_2019["izquierda"] / (df_2019["derecha"]+df_2019["izquierda"])
+df_2019 = add_bloc_shares(df_2019, ['derecha', 'izquierda'])
 
 # 2021
-df_2021['derecha'] = df_2021["pp"] + df_2021["cs"] + df_2021["vox"]
-df_2021['izquierda'] = df_2021["psoe"]+ df_2021["mas_madrid"] + df_2021["podemos_iu"] 
-
-df_2021["derecha_share"] = df_2021["derecha"] / df_2021["votos_totales"]
-df_2021["rel_derecha_share"] = df_2021["derecha"] / (df_2021["derecha"]+df_2021["izquierda"])
-df_2021["izquierda_share"] = df_2021["izquierda"] / df_2021["votos_totales"]
-df_2021["rel_izquierda_share"] = df_2021["izquierda"] / (df_2021["derecha"]+df_2021["izquierda"])
+df_2021 = add_bloc_shares(df_2021, ['derecha', 'izquierda'])
 
 
 # In[95]:
 
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1594,8 +2884,7 @@ show(p)
 # In[96]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1614,28 +2903,28 @@ show(p)
 
 
 # municipios ganados por el eje de la derecha al eje de la izquierda en 2019
-won_municipalities('derecha', 'izquierda', df_2019)
+wins.loc[(2019, 'derecha'), 'izquierda']
 
 
 # In[98]:
 
 
 # municipios ganados por el eje de la izquierda al eje de la derecha en 2019
-won_municipalities('izquierda', 'derecha', df_2019)
+wins.loc[(2019, 'izquierda'), 'derecha']
 
 
 # In[99]:
 
 
 # municipios ganados por el eje de la derecha al eje de la izquierda en 2021
-won_municipalities('derecha', 'izquierda', df_2021)
+wins.loc[(2021, 'derecha'), 'izquierda']
 
 
 # In[100]:
 
 
 # municipios ganados por el eje de la izquierda al eje de la derecha en 2021
-won_municipalities('izquierda', 'derecha', df_2021)
+wins.loc[(2021, 'izquierda'), 'derecha']
 
 
 # Se puede apreciar el gran avance general de la derecha en la Comunidad de Madrid: pasa de 127 municipios en 2019 a 159 en 2021; mientras que la izquierda pasa de 51 a solo 19 municipios.
@@ -1646,23 +2935,16 @@ won_municipalities('izquierda', 'derecha', df_2021)
 
 
 # 2019
-df_2019["pp_share"] = df_2019["pp"] / df_2019["votos_totales"]
-df_2019["rel_pp_share"] = df_2019["pp"] / (df_2019["pp"]+df_2019["mas_madrid"])
-df_2019["mas_madrid_share"] = df_2019["mas_madrid"] / df_2019["votos_totales"]
-df_2019["rel_mas_madrid_share"] = df_2019["mas_madrid"] / (df_2019["pp"]+df_2019["mas_madrid"])
+df_2019 = add_bloc_shares(df_2019, ['pp', 'mas_madrid'])
 
 # 2021
-df_2021["pp_share"] = df_2021["pp"] / df_2021["votos_totales"]
-df_2021["rel_pp_share"] = df_2021["pp"] / (df_2021["pp"]+df_2021["mas_madrid"])
-df_2021["mas_madrid_share"] = df_2021["mas_madrid"] / df_2021["votos_totales"]
-df_2021["rel_mas_madrid_share"] = df_2021["mas_madrid"] / (df_2021["pp"]+df_2021["mas_madrid"])
+df_2021 = add_bloc_shares(df_2021, ['pp', 'mas_madrid'])
 
 
 # In[102]:
 
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1680,8 +2962,7 @@ show(p)
 # In[103]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1700,28 +2981,28 @@ show(p)
 
 
 # municipios ganados por el PP a Más Madrid en 2019
-won_municipalities('pp', 'mas_madrid', df_2019)
+wins.loc[(2019, 'pp'), 'mas_madrid']
 
 
 # In[105]:
 
 
 # municipios ganados por Más Madrid a el PP en 2019
-won_municipalities('mas_madrid', 'pp', df_2019)
+wins.loc[(2019, 'mas_madrid'), 'pp']
 
 
 # In[106]:
 
 
 # municipios ganados por el PP a Más Madrid en 2019
-won_municipalities('pp', 'mas_madrid', df_2021)
+wins.loc[(2021, 'pp'), 'mas_madrid']
 
 
 # In[107]:
 
 
 # municipios ganados por Más Madrid a el PP en 2019
-won_municipalities('mas_madrid', 'pp', df_2021)
+wins.loc[(2021, 'mas_madrid'), 'pp']
 
 
 # Más Madrid, que fue el partido dentro del eje de izquierdas y que consiguió dar el sorpaso al PSOE, pasó de tener 10 municipios donde sacó más votos que el PP en las elecciones de 2019 a ninguno en las elecciones de 2021. Por lo tanto, a pesar del sorpaso, el PP mantiene el tipo frente a todos los partidos de izquierdas.
@@ -1736,23 +3017,16 @@ won_municipalities('mas_madrid', 'pp', df_2021)
 
 
 # 2019
-df_2019["podemos_iu_share"] = df_2019["podemos_iu"] / df_2019["votos_totales"]
-df_2019["rel_podemos_iu_share"] = df_2019["podemos_iu"] / (df_2019["podemos_iu"]+df_2019["mas_madrid"])
-df_2019["mas_madrid_share"] = df_2019["mas_madrid"] / df_2019["votos_totales"]
-df_2019["rel_mas_madrid_share"] = df_2019["mas_madrid"] / (df_2019["podemos_iu"]+df_2019["mas_madrid"])
+df_2019 = add_bloc_shares(df_2019, ['podemos_iu', 'mas_madrid'])
 
 # 2021
-df_2021["podemos_iu_share"] = df_2021["podemos_iu"] / df_2021["votos_totales"]
-df_2021["rel_podemos_iu_share"] = df_2021["podemos_iu"] / (df_2021["podemos_iu"]+df_2021["mas_madrid"])
-df_2021["mas_madrid_share"] = df_2021["mas_madrid"] / df_2021["votos_totales"]
-df_2021["rel_mas_madrid_share"] = df_2021["mas_madrid"] / (df_2021["podemos_iu"]+df_2021["mas_madrid"])
+df_2021 = add_bloc_shares(df_2021, ['podemos_iu', 'mas_madrid'])
 
 
 # In[109]:
 
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1770,8 +3044,7 @@ show(p)
 # In[110]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1790,28 +3063,28 @@ show(p)
 
 
 # municipios ganados por Más Madrid a Podemos-IU en 2019
-won_municipalities('mas_madrid', 'podemos_iu', df_2019)
+wins.loc[(2019, 'mas_madrid'), 'podemos_iu']
 
 
 # In[112]:
 
 
 # municipios ganados por Podemos-IU a Más Madrid en 2019
-won_municipalities('podemos_iu', 'mas_madrid', df_2019)
+wins.loc[(2019, 'podemos_iu'), 'mas_madrid']
 
 
 # In[113]:
 
 
 # municipios ganados por Más Madrid a Podemos-IU en 2021
-won_municipalities('mas_madrid', 'podemos_iu', df_2021)
+wins.loc[(2021, 'mas_madrid'), 'podemos_iu']
 
 
 # In[114]:
 
 
 # municipios ganados por Podemos-IU a Más Madrid en 2021
-won_municipalities('podemos_iu', 'mas_madrid', df_2021)
+wins.loc[(2021, 'podemos_iu'), 'mas_madrid']
 
 
 # Vemos cómo el apoyo a Más Madrid crece entre las dos elecciones con respecto a Podemos-IU, ya que pasa de 160 municipios donde suma más votos frente a 17 a 173 contra 6. Esto puede reflejar que el ser parte del Gobierno a nivel nacional le ha pasado factura a Podemos-IU.
@@ -1828,40 +3101,22 @@ won_municipalities('podemos_iu', 'mas_madrid', df_2021)
 
 
 def electoral_abstention(df_year):
-    abstention_total_votes = df_year['abstencion'].sum()
-    abstention_total_percentage = (df_year['abstencion'].sum()/df_year['votos_totales'].sum())*100
-    
-    abstention_total_votes = str("{:,}".format(abstention_total_votes)).strip('.0')+' votos'
-    abstention_total_percentage = str(round(abstention_total_percentage, 2))+' %'
-    
-    return [abstention_total_votes, abstention_total_percentage]
+    return total_results('abstencion', df_year)
 
 
 # In[116]:
 
 
 def dif_electoral_abstention(df_year_1, df_year_2):
-    abstention_total_votes_1 = df_year_1['abstencion'].sum()
-    abstention_total_percentage_1 = (df_year_1['abstencion'].sum()/df_year_1['votos_totales'].sum())*100
-    
-    abstention_total_votes_2 = df_year_2['abstencion'].sum()
-    abstention_total_percentage_2 = (df_year_2['abstencion'].sum()/df_year_2['votos_totales'].sum())*100
-    
-    diff_abstention_votes = abstention_total_votes_1 - abstention_total_votes_2
-    diff_abstention_percentage = abstention_total_percentage_1 - abstention_total_percentage_2
-    
-    abstencion_total_votes = str("{:,}".format(diff_abstention_votes)).strip('.0')+' votos'
-    abstention_total_percentage = str(round(diff_abstention_percentage, 2))+' %'
-    
-    return [abstencion_total_votes, abstention_total_percentage]
+    return difference_elections('abstencion', df_year_1, df_year_2)
 
 
 # In[117]:
 
 
-print('Abstención 2019: '+ electoral_abstention(df_2019)[0] +' / '+ electoral_abstention(df_2019)[1])
-print('Abstención 2021: '+ electoral_abstention(df_2021)[0] +' / '+ electoral_abstention(df_2021)[1])
-print('Diferencia 2021-2019: '+ dif_electoral_abstention(df_2021, df_2019)[0] +' / '+ dif_electoral_abstention(df_2021, df_2019)[1])
+print('Abstención 2019: '+ ' / '.join(electoral_abstention(df_2019)))
+print('Abstención 2021: '+ ' / '.join(electoral_abstention(df_2021)))
+print('Diferencia 2021-2019: '+ ' / '.join(dif_electoral_abstention(df_2021, df_2019)))
 
 
 # Podemos ver cómo la abstención pasa de representar el 46.89% del total en las elecciones del 2019 (1,516,826 votos) a el 31.15% (1,135,201 votos), lo que supone una caída porcentual del 15.74% (-381,625 votos). Usualmente se atribuyen una menor a abstención a una mayor movilización de la izquierda, pero aquí vemos lo contrario: en 2019 obtiene más votos el candidato del PSOE, mientras que en 2021 la candidata del PP.
@@ -1889,8 +3144,7 @@ df_2021["rel_votos_totales_share"] = df_2021["votos_totales"] / (df_2021["absten
 # In[119]:
 
 
-result = GeoDataFrame(df_2019)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2019, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1908,8 +3162,7 @@ show(p)
 # In[120]:
 
 
-result = GeoDataFrame(df_2021)
-wi_geojson=GeoJSONDataSource(geojson=result.to_json())
+wi_geojson=map_source(df_2021, map_levels)
 
 color_mapper = LinearColorMapper(palette = brewer['RdBu'][10], low = 0, high = 1)
 color_bar = ColorBar(color_mapper=color_mapper, label_standoff=8,width = 500, height = 20,
@@ -1933,14 +3186,17 @@ show(p)
 
 import pandas as pd
 
-df_abstenciones = pd.DataFrame()
-df_abstenciones['municipio'] = df_2021['municipio']
-df_abstenciones['votos_totales_2019'] = df_2019['votos_totales']
-df_abstenciones['votos_totales_2021'] = df_2021['votos_totales']
-df_abstenciones['abstencion_2019'] = df_2019['abstencion']
-df_abstenciones['abstencion_2021'] = df_2021['abstencion']
+# cruzamos por código INE, no por la posición de las filas:
+columns = ['votos_totales', 'abstencion', 'abstencion_porcentaje']
+df_abstenciones = df_2019[['ine'] + columns].merge(
+    df_2021[['ine', 'municipio'] + columns], on='ine', how='inner', suffixes=('_2019', '_2021')
+)
 df_abstenciones['dif_abstencion_votos'] = df_abstenciones['abstencion_2021'] - df_abstenciones['abstencion_2019']
-df_abstenciones['dif_abstencion_porcentaje'] = df_2021['abstencion_porcentaje'] - df_2019['abstencion_porcentaje']
+df_abstenciones['dif_abstencion_porcentaje'] = df_abstenciones['abstencion_porcentaje_2021'] - df_abstenciones['abstencion_porcentaje_2019']
+df_abstenciones = df_abstenciones[[
+    'ine', 'municipio', 'votos_totales_2019', 'votos_totales_2021', 'abstencion_2019', 'abstencion_2021',
+    'dif_abstencion_votos', 'dif_abstencion_porcentaje',
+]]
 
 
 # In[122]:
@@ -1993,3 +3249,107 @@ df_abstenciones.nsmallest(15, ['dif_abstencion_porcentaje'])
 # 
 # 
 # * En cuanto a la participación, las elecciones de 2021 han desmitificado que una participación alta sea sinónimo de un mayor apoyo hacia la izquierda vistos los resultados. Se podría decir que esta mayor movilización se ha debido a los liderazgos principales de Isabel Díaz Ayuso y Pablo Iglesias Turrión, que han movilizado el voto a uno y otro lado.
+
+
+# ## Anexo: entorno local de pruebas
+
+# Todas las fases del "scrapper" dependen de las páginas de resultados.elpais.com, así que cualquier medida de rendimiento depende de la red y del estado del servidor en ese momento. Para poder medir de forma reproducible sin conexión:
+# 
+# * `record_fixtures(years)` guarda en `fixtures/elpais` (con la misma estructura de rutas que la web) la página índice y las páginas de todos los municipios de cada año, con los mismos enlaces del índice INE que recorre el "scrapper". Las descargas pasan por la caché, así que con la caché ya llena se puede grabar en modo offline. Las páginas grabadas no se ignoran en git: se graban una vez en una máquina con red desde la carpeta `madrid-elections-book/` y se suben al repositorio (`git add fixtures/elpais`), y así cualquier máquina sin red tiene el mismo corpus para medir.
+# * `serve_fixtures()` levanta un servidor HTTP local en un hilo que sirve esas páginas con una latencia, un jitter y una tasa de errores 503 configurables (con semilla, para que los errores sean siempre los mismos). Responde con `ETag` y `304` como el servidor real.
+# 
+# Para medir el "scrapper" contra el servidor local basta con cambiar la url base, usando una caché y un diario vacíos para que no se sirva nada desde disco:
+# 
+# ```python
+# server = serve_fixtures(latency=0.05, jitter=0.02, error_rate=0.01)
+# HTTP_CACHE_DIR = tempfile.mkdtemp()
+# df = extract_data_from_web(server.base_url + '/elecciones/2019/autonomicas/12/', workers=8, checkpoint=False)
+# server.shutdown()
+# ```
+
+# In[ ]:
+
+
+from urllib.parse import urlparse
+
+FIXTURES_DIR = 'fixtures/elpais'
+
+def fixture_path(url, root=FIXTURES_DIR):
+    path = urlparse(url).path
+    if path.endswith('/'):
+        path += 'index.html'
+    
+    return os.path.join(root, path.lstrip('/'))
+
+
+def record_fixtures(years=(2019, 2021), root=FIXTURES_DIR, offline=None):
+    recorded = []
+    for year in years:
+        url = ELPAIS_URL.format(year=year)
+        # los mismos enlaces que recorre el "scrapper" (índice INE, La Acebeda incluida) más la página índice:
+        links = [url] + [link for municipio, link in municipio_links(url)]
+        
+        # guardamos el texto ya decodificado en utf-8, que es lo que declara el servidor local:
+        for link in links:
+            atomic_write(fixture_path(link, root), fetch(link, offline=offline).encode('utf-8'))
+            recorded.append(link)
+    
+    return recorded
+
+
+# In[ ]:
+
+
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def serve_fixtures(root=FIXTURES_DIR, port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+    if not os.path.isdir(root):
+        raise FileNotFoundError('no hay páginas grabadas en %s: hay que grabarlas con record_fixtures() en una máquina con red' % root)
+    
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with rng_lock:
+                delay = latency + rng.uniform(0, jitter)
+                fail = rng.random() < error_rate
+            time.sleep(delay)
+            
+            path = fixture_path(self.path, root)
+            inside_root = os.path.abspath(path).startswith(os.path.abspath(root) + os.sep)
+            if fail:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if not inside_root or not os.path.isfile(path):
+                self.send_error(404)
+                return
+            
+            with open(path, 'rb') as f:
+                body = f.read()
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+    server.daemon_threads = True
+    server.base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    return server